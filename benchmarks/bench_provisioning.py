@@ -0,0 +1,69 @@
+"""
+    Benchmark of the tenant provisioning against a local Postgres.
+
+    python -m benchmarks.bench_provisioning --tenants 1000
+    python -m benchmarks.bench_provisioning --tenants 1000 --mode legacy
+
+    script runs the rendered schema script in one transaction (create_schema),
+    legacy creates the tables with create_all and the brands with the ORM.
+    The schemas are dropped at the end.
+"""
+import argparse, statistics, time
+from dotenv import load_dotenv
+load_dotenv()
+
+from sqlalchemy import text
+from database.database import (Base, engine, session)
+from database.models_countries import (create_schema, create_tables, add_default_values,
+                                       delete_schema)
+
+def provision_legacy(schema_name:str, db):
+    """
+        Provisioning before the schema script, kept to compare
+    """
+    with engine.begin() as connection:
+        connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema_name}"))
+    create_tables(schema_name)
+    add_default_values(schema_name, db)
+
+def prepare_db():
+    """
+        Create the administration tables that the tenant tables reference
+    """
+    with engine.begin() as connection:
+        connection.execute(text("CREATE SCHEMA IF NOT EXISTS administration"))
+    Base.metadata.create_all(engine, tables=[table for table in Base.metadata.sorted_tables
+                                             if table.schema == 'administration'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Tenant provisioning benchmark')
+    parser.add_argument('--tenants', type=int, default=1000)
+    parser.add_argument('--mode', choices=['script', 'legacy'], default='script')
+    parser.add_argument('--prefix', default='bench')
+    args = parser.parse_args()
+    schemas = [f"{args.prefix}_{i}_schema" for i in range(args.tenants)]
+    timings = []
+    prepare_db()
+    db = session()
+    try:
+        start = time.perf_counter()
+        for schema_name in schemas:
+            tenant_start = time.perf_counter()
+            if args.mode == 'script':
+                create_schema(schema_name, db)
+            else:
+                provision_legacy(schema_name, db)
+            timings.append(time.perf_counter() - tenant_start)
+        total = time.perf_counter() - start
+    finally:
+        db.close()
+        for schema_name in schemas:
+            delete_schema(schema_name)
+    timings.sort()
+    print(f"mode={args.mode} tenants={len(timings)} total={total:.2f}s "
+          f"mean={statistics.mean(timings) * 1000:.1f}ms "
+          f"p50={timings[len(timings) // 2] * 1000:.1f}ms "
+          f"p99={timings[int(len(timings) * 0.99) - 1] * 1000:.1f}ms")
+
+if __name__ == '__main__':
+    main()
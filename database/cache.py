@@ -0,0 +1,202 @@
+"""
+    Process wide caches for the tenant (schema) metadata
+"""
+import os, time, threading
+from collections import OrderedDict
+from sqlalchemy import (MetaData, Table, inspect)
+
+# Returned when a key is not cached, None is a valid cached value
+MISSING = object()
+
+class TTLCache(object):
+    """
+        Thread safe LRU map, the entries expire after ttl seconds (None never expire)
+    """
+    def __init__(self, maxsize:int = 1024, ttl:float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """
+            Return the value of the key if it is cached and not expired
+        """
+        with self._lock:
+            item = self._data.get(key, MISSING)
+            if item is MISSING:
+                return default
+            value, expire_at = item
+            if expire_at is not None and expire_at < time.monotonic():
+                self._data.pop(key, None)
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+            Save the value and remove the least recently used keys
+        """
+        expire_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expire_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        """
+            Remove a key
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+            Remove every key
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+# alias -> schema name
+TENANT_CACHE_TTL = float(os.getenv('TENANT_CACHE_TTL', 300))
+TENANT_CACHE_SIZE = int(os.getenv('TENANT_CACHE_SIZE', 4096))
+_tenants = TTLCache(TENANT_CACHE_SIZE, TENANT_CACHE_TTL)
+# aliases that are not a country, they have their own small cache so the labels of
+# arbitrary Host headers never evict the countries
+MISSING_TENANT_CACHE_TTL = float(os.getenv('MISSING_TENANT_CACHE_TTL', 5))
+MISSING_TENANT_CACHE_SIZE = int(os.getenv('MISSING_TENANT_CACHE_SIZE', 1024))
+_missing_tenants = TTLCache(MISSING_TENANT_CACHE_SIZE, MISSING_TENANT_CACHE_TTL)
+# session user -> validated principal (UserResponseRol)
+PRINCIPAL_CACHE_TTL = float(os.getenv('PRINCIPAL_CACHE_TTL', 30))
+PRINCIPAL_CACHE_SIZE = int(os.getenv('PRINCIPAL_CACHE_SIZE', 10000))
+_principals = TTLCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+_lock = threading.RLock()
+# schema name -> ddl version, bumped every time a table of the schema changes
+_schema_versions = {}
+# (schema name, table name) -> (ddl version, reflected table)
+_tables = {}
+# (schema name, brand id) -> brand name (the brand name is the table name)
+_brands = {}
+# Columns with this prefix are internal (shadow columns of a type change)
+HIDDEN_PREFIX = '__'
+
+def get_schema_version(schema_name:str) -> int:
+    """
+        Return the current ddl version of a schema
+    """
+    return _schema_versions.get(schema_name, 0)
+
+def bump_schema_version(schema_name:str) -> int:
+    """
+        Invalidate every cached object of a schema after a ddl change
+    """
+    with _lock:
+        version = _schema_versions.get(schema_name, 0) + 1
+        _schema_versions[schema_name] = version
+        for key in [key for key in _tables if key[0] == schema_name]:
+            _tables.pop(key, None)
+        for key in [key for key in _brands if key[0] == schema_name]:
+            _brands.pop(key, None)
+    return version
+
+def get_table(schema_name:str, table_name:str, bind, get_hidden_columns=None) -> Table:
+    """
+        Return the reflected table, only reflect it when the ddl version changed.
+        The hidden columns (HIDDEN_PREFIX or returned by get_hidden_columns) are
+        not reflected
+    """
+    version = get_schema_version(schema_name)
+    cached = _tables.get((schema_name, table_name))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    hidden = get_hidden_columns() if get_hidden_columns is not None else set()
+    columns = [column['name'] for column in inspect(bind).get_columns(table_name, schema_name)
+               if not column['name'].startswith(HIDDEN_PREFIX) and column['name'] not in hidden]
+    table = Table(table_name, MetaData(schema=schema_name), autoload_with=bind,
+                  include_columns=columns)
+    table.info['schema_version'] = version
+    with _lock:
+        # A ddl could run while reflecting, in that case do not keep the old table
+        if get_schema_version(schema_name) == version:
+            _tables[(schema_name, table_name)] = (version, table)
+    return table
+
+def get_cached_brand(schema_name:str, brand_id:int):
+    """
+        Return the name of the brand if it is cached
+    """
+    return _brands.get((schema_name, brand_id))
+
+def cache_brand(schema_name:str, brand_id:int, name:str, version:int):
+    """
+        Save the brand name while the ddl version is the same
+    """
+    with _lock:
+        if get_schema_version(schema_name) == version:
+            _brands[(schema_name, brand_id)] = name
+
+def clear_cache():
+    """
+        Invalidate the cache of every schema
+    """
+    with _lock:
+        schemas = set(_schema_versions) | {key[0] for key in _tables} | {key[0] for key in _brands}
+        for schema_name in schemas:
+            bump_schema_version(schema_name)
+
+def get_cached_tenant(country_alias:str):
+    """
+        Return the schema name of the alias, MISSING if it is not cached
+    """
+    schema_name = _tenants.get(country_alias.lower())
+    if schema_name is MISSING:
+        return _missing_tenants.get(country_alias.lower())
+    return schema_name
+
+def cache_tenant(country_alias:str, schema_name:str):
+    """
+        Save the schema name of the alias, None save that the alias does not exist
+        for a short time
+    """
+    if schema_name is None:
+        _missing_tenants.set(country_alias.lower(), None)
+    else:
+        _missing_tenants.pop(country_alias.lower())
+        _tenants.set(country_alias.lower(), schema_name)
+
+def invalidate_tenant(country_alias:str = None):
+    """
+        Remove the alias from the tenant cache (all aliases if it is None)
+    """
+    if country_alias is None:
+        _tenants.clear()
+        _missing_tenants.clear()
+    else:
+        _tenants.pop(country_alias.lower())
+        _missing_tenants.pop(country_alias.lower())
+
+def get_cached_principal(key):
+    """
+        Return the principal of the session user, MISSING if it is not cached
+    """
+    return _principals.get(key)
+
+def cache_principal(key, principal):
+    """
+        Save the principal of the session user
+    """
+    _principals.set(key, principal)
+
+def invalidate_principal(key = None):
+    """
+        Remove the principal of a user (all principals if it is None)
+    """
+    if key is None:
+        _principals.clear()
+    else:
+        _principals.pop(key)
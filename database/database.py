@@ -1,9 +1,11 @@
 """
     This file will contain the sql alchemy informatin about the db
 """
-import os
-from sqlalchemy import create_engine
+import os, re
+from uuid import uuid4
+from sqlalchemy import (create_engine, event, make_url)
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import (create_async_engine, async_sessionmaker)
 from sqlalchemy.ext.declarative import declarative_base
 from fastapi import Depends
 # DB_URL = "sqlite:///./mydb.db"
@@ -31,13 +33,81 @@ def is_test_environemnt():
             return True
     return False
 
+def is_transaction_pooler():
+    """
+        Check if the db is behind a pooler in transaction mode (pgbouncer), each
+        transaction could run in a different server connection
+    """
+    return os.getenv('DB_POOL_MODE', 'session') == 'transaction'
+
+# Statements that keep state in the server connection after the transaction
+SESSION_STATEMENT = re.compile(r"^\s*(SET\s+(?!LOCAL\s|TRANSACTION\s)|RESET\s|LISTEN\s|"
+                               r"PREPARE\s|DISCARD\s)", re.IGNORECASE)
+
+def forbid_session_state(bind):
+    """
+        Reject the statements that leave state in the server connection, behind a
+        transaction pooler that state leaks to the next client of the connection
+    """
+    @event.listens_for(bind, 'before_cursor_execute')
+    def check_statement(conn, cursor, statement, parameters, context, executemany):
+        # A script can run many statements, check each one of them
+        if any(SESSION_STATEMENT.match(part) for part in statement.split(';')):
+            raise Exception(f"Session level statement not allowed with a transaction pooler: {statement}")
+    return bind
+
 engine = create_engine(DB_URL if not is_test_environemnt() else DB_URL_TEST)
+if is_transaction_pooler():
+    forbid_session_state(engine)
 # print(is_test_environemnt())
 session = sessionmaker(bind=engine, autoflush=False, autocommit = False)
 
+def get_async_url(url):
+    """
+        Return the url using the asyncpg driver
+    """
+    return make_url(url).set(drivername='postgresql+asyncpg')
+
+# asyncpg prepares the statements in the server connection, behind a transaction
+# pooler do not cache them and use unique names so they never collide in other
+# client of the pooler
+POOLER_ASYNC_CONNECT_ARGS = {
+    'statement_cache_size': 0,
+    'prepared_statement_cache_size': 0,
+    'prepared_statement_name_func': lambda: f"__asyncpg_{uuid4()}__",
+}
+async_engine_options = {}
+if is_transaction_pooler():
+    async_engine_options['connect_args'] = POOLER_ASYNC_CONNECT_ARGS
+async_engine = create_async_engine(get_async_url(DB_URL if not is_test_environemnt() else DB_URL_TEST),
+                                   **async_engine_options)
+if is_transaction_pooler():
+    forbid_session_state(async_engine.sync_engine)
+# The instances are not expired after commit, in async they cannot be lazy loaded
+async_session = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
+def tenant_session(schema_name:str, bind=None):
+    """
+        Create a session where the tenant tables (tables without schema) are
+        rendered inside the schema, nothing is sent to the db to switch the schema
+    """
+    bind = bind if bind is not None else engine
+    db = session(bind=bind.execution_options(schema_translate_map={None: schema_name}))
+    db.info['schema_name'] = schema_name
+    return db
+
+def async_tenant_session(schema_name:str, bind=None):
+    """
+        Async version of tenant_session
+    """
+    bind = bind if bind is not None else async_engine
+    db = async_session(bind=bind.execution_options(schema_translate_map={None: schema_name}))
+    db.info['schema_name'] = schema_name
+    return db
+
 def get_db():
     """
         Create db session
@@ -48,6 +118,13 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """
+        Create async db session
+    """
+    async with async_session() as db:
+        yield db
+
 async def create_db():
 
     # Create all tables for the current schema
@@ -0,0 +1,151 @@
+"""
+    Provisioning and teardown of the tenant schemas, the jobs run in a bounded
+    pool of workers so they never hold a web worker or a request connection
+"""
+import os, threading, logging, datetime
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import (HTTPException, status)
+from sqlalchemy import (update, create_engine)
+from sqlalchemy.orm import sessionmaker
+from database.database import (engine, is_transaction_pooler, forbid_session_state)
+from database.models_admin import (Jobs, Countries)
+from database.models_countries import (create_schema, delete_schema)
+from database.cache import invalidate_tenant
+from database.notify import publish_tenant
+
+# Jobs running at the same time, each one uses a connection
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Jobs waiting for a worker, the requests over this limit are rejected with 429
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 50))
+# Seconds after which a running job is taken as left by a stopped worker
+JOB_STALE = int(os.getenv('JOB_STALE', 3600))
+logger = logging.getLogger(__name__)
+# The jobs use their own pool, a long provisioning never takes a connection of
+# the requests
+job_engine = create_engine(engine.url, pool_size=JOB_WORKERS, max_overflow=0)
+if is_transaction_pooler():
+    forbid_session_state(job_engine)
+job_session = sessionmaker(bind=job_engine, autoflush=False, autocommit=False)
+
+_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_SIZE)
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+        Return the pool of workers, it is created on the first use
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+    return _executor
+
+def reserve_job_slot():
+    """
+        Reserve a place in the queue before creating a job, raise 429 if it is full
+    """
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many jobs, try again later",
+                            headers={'Retry-After': '5'})
+
+def release_job_slot():
+    """
+        Release a reserved place that was not used
+    """
+    _slots.release()
+
+def submit_job(job_id:int):
+    """
+        Run a job in the pool with a slot reserved by reserve_job_slot
+    """
+    try:
+        future = get_executor().submit(run_job, job_id)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(finish_job)
+    return future
+
+def finish_job(future):
+    """
+        Release the slot of a finished job, the errors out of the job are logged
+    """
+    _slots.release()
+    error = future.exception()
+    if error is not None:
+        logger.error("Job failed", exc_info=error)
+
+def utc_now():
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+def run_job(job_id:int):
+    """
+        Run a pending job, it is claimed with an update so it only runs once
+    """
+    db = job_session()
+    try:
+        claimed = db.execute(update(Jobs).where(Jobs.id == job_id, Jobs.status == 'pending')
+                             .values(status='running', started_at=utc_now())
+                             .returning(Jobs.kind, Jobs.schema_name, Jobs.country_id,
+                                        Jobs.country_alias)).first()
+        db.commit()
+        if claimed is None:
+            return
+        kind, schema_name, country_id, country_alias = claimed
+        values = {'status': 'done', 'error': None}
+        try:
+            if kind == 'create_country':
+                create_schema(schema_name, db)
+            elif kind == 'delete_country':
+                delete_schema(schema_name, job_engine)
+            else:
+                raise Exception(f"{kind} is not a valid job")
+        except Exception as e:
+            logger.warning("Job %s failed: %s", job_id, e)
+            values = {'status': 'failed', 'error': str(e)}
+            if kind == 'create_country' and country_id is not None:
+                # The schema is created in one transaction, remove the country so
+                # it can be created again
+                db.query(Countries).filter(Countries.id == country_id).delete()
+        if country_alias is not None:
+            publish_tenant(db, country_alias)
+        db.execute(update(Jobs).where(Jobs.id == job_id).values(finished_at=utc_now(), **values))
+        db.commit()
+        if country_alias is not None:
+            invalidate_tenant(country_alias)
+    finally:
+        db.close()
+
+def resume_jobs():
+    """
+        Submit the pending jobs of a worker that stopped before running them, the
+        running jobs older than JOB_STALE run again, the schema jobs are idempotent
+    """
+    Jobs.__table__.create(job_engine, checkfirst=True)
+    db = job_session()
+    try:
+        stale = utc_now() - datetime.timedelta(seconds=JOB_STALE)
+        db.execute(update(Jobs).where(Jobs.status == 'running', Jobs.started_at < stale)
+                   .values(status='pending', started_at=None))
+        db.commit()
+        job_ids = [job.id for job in db.query(Jobs).filter(Jobs.status == 'pending')
+                   .order_by(Jobs.id).all()]
+    finally:
+        db.close()
+    for job_id in job_ids:
+        if not _slots.acquire(blocking=False):
+            break
+        submit_job(job_id)
+
+def shutdown_jobs():
+    """
+        Stop the pool of workers, the running jobs finish first
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+    job_engine.dispose()
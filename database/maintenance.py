@@ -0,0 +1,60 @@
+"""
+    Background maintenance of the tenant schemas, drops the hidden columns of the
+    deleted extras, resumes the type changes stopped by a restart and builds
+    again the failed indexes
+"""
+import os, threading, logging
+from database.models_countries import (purge_dropped_columns, resume_type_changes,
+                                       retry_failed_indexes)
+from database.services_tenant import get_tenant_schemas
+
+# Seconds between each run of the maintenance
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', 60))
+logger = logging.getLogger(__name__)
+_stop = threading.Event()
+_thread = None
+
+def run_maintenance() -> int:
+    """
+        Drop the hidden columns, resume the stopped type changes and build the
+        failed indexes of every schema, return the number of dropped columns
+    """
+    dropped = 0
+    for schema_name in get_tenant_schemas():
+        try:
+            resume_type_changes(schema_name)
+            dropped += purge_dropped_columns(schema_name)
+            retry_failed_indexes(schema_name)
+        except Exception as e:
+            logger.warning("Maintenance error in %s: %s", schema_name, e)
+    return dropped
+
+def maintain():
+    """
+        Run the maintenance until the worker is stopped
+    """
+    while not _stop.wait(MAINTENANCE_INTERVAL):
+        try:
+            run_maintenance()
+        except Exception as e:
+            logger.warning("Maintenance error %s", e)
+
+def start_maintenance():
+    """
+        Start the maintenance thread of this worker
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return _thread
+    _stop.clear()
+    _thread = threading.Thread(target=maintain, name='tenant-maintenance', daemon=True)
+    _thread.start()
+    return _thread
+
+def stop_maintenance():
+    """
+        Stop the maintenance thread
+    """
+    _stop.set()
+    if _thread is not None:
+        _thread.join(5)
@@ -0,0 +1,166 @@
+"""
+    Versioned migrations of the tenant schemas, they are applied to every schema
+    in parallel with a bounded number of connections.
+
+    python -m database.migrations --workers 8
+    python -m database.migrations --schema mexico_mx_schema --target 2
+
+    Each migration runs in its own transaction with the version of the schema,
+    so a failed schema resumes from its last version in the next run. New
+    tenants are created with the last tables, the migrations must be idempotent
+"""
+import os, time, logging, argparse, datetime
+from dotenv import load_dotenv
+load_dotenv()
+
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import (create_engine, select, text)
+from sqlalchemy.dialects.postgresql import insert
+from database.database import (engine, is_transaction_pooler, forbid_session_state)
+from database.models_admin import (SchemaMigrations, Jobs)
+from database.models_countries import (ExtraTypeChange, ExtraTombstone, create_extensions,
+                                       get_search_indexes)
+from database.services_tenant import get_tenant_schemas
+from database.cache import (bump_schema_version, get_schema_version)
+from database.notify import publish_ddl
+
+# Connections used at the same time by the runner
+MIGRATION_WORKERS = int(os.getenv('MIGRATION_WORKERS', 8))
+# A migration waits at most this time for the lock of a table
+MIGRATION_LOCK_TIMEOUT = os.getenv('MIGRATION_LOCK_TIMEOUT', '5s')
+logger = logging.getLogger(__name__)
+
+def add_extras_index_columns(connection, schema_name:str):
+    connection.execute(text(f"""
+    ALTER TABLE {schema_name}.extras
+    ADD COLUMN IF NOT EXISTS indexed BOOLEAN NOT NULL DEFAULT false,
+    ADD COLUMN IF NOT EXISTS index_type VARCHAR,
+    ADD COLUMN IF NOT EXISTS index_status VARCHAR
+    """))
+
+def add_search_indexes(connection, schema_name:str):
+    # pg_trgm is created once by run_migrations before the workers, without it
+    # only the btree indexes are created
+    for index_name, definition in get_search_indexes().items():
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} "
+                                f"ON {schema_name}.{definition}"))
+
+def add_type_change_table(connection, schema_name:str):
+    ExtraTypeChange.__table__.create(
+        connection.execution_options(schema_translate_map={None: schema_name}), checkfirst=True)
+
+def add_tombstone_table(connection, schema_name:str):
+    ExtraTombstone.__table__.create(
+        connection.execution_options(schema_translate_map={None: schema_name}), checkfirst=True)
+
+# (version, description, function), append the new migrations at the end
+MIGRATIONS = [
+    (1, 'index columns of the extras', add_extras_index_columns),
+    (2, 'trigram indexes of the extras search', add_search_indexes),
+    (3, 'progress of the extras type changes', add_type_change_table),
+    (4, 'tombstones of the deleted extras', add_tombstone_table),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_migration_engine(workers:int):
+    """
+        Return an engine whose pool is the connection budget of the runner
+    """
+    migration_engine = create_engine(engine.url, pool_size=workers, max_overflow=0)
+    if is_transaction_pooler():
+        forbid_session_state(migration_engine)
+    return migration_engine
+
+def save_version(connection, schema_name:str, version:int, status:str = 'done',
+                 error:str = None):
+    """
+        Save the version of a schema
+    """
+    values = {'version': version, 'status': status, 'error': error,
+              'updated_at': datetime.datetime.now(tz=datetime.timezone.utc)}
+    query = insert(SchemaMigrations).values(schema_name=schema_name, **values)
+    connection.execute(query.on_conflict_do_update(index_elements=['schema_name'], set_=values))
+
+def migrate_schema(migration_engine, schema_name:str, target:int = LATEST_VERSION) -> dict:
+    """
+        Apply the pending migrations of a schema, each one in its own transaction.
+        The schema is skipped if other runner is migrating it
+    """
+    result = {'schema': schema_name, 'status': 'done', 'applied': 0, 'version': 0}
+    with migration_engine.connect() as connection:
+        for version, description, function in MIGRATIONS:
+            if version > target:
+                break
+            try:
+                with connection.begin():
+                    # Only one runner migrates a schema at the same time
+                    locked = connection.execute(text("SELECT pg_try_advisory_xact_lock(hashtext(:key))"),
+                                                {'key': f"migrations.{schema_name}"}).scalar()
+                    if not locked:
+                        result['status'] = 'locked'
+                        return result
+                    current = connection.execute(
+                        select(SchemaMigrations.version)
+                        .where(SchemaMigrations.schema_name == schema_name)).scalar() or 0
+                    result['version'] = current
+                    if current >= version:
+                        continue
+                    connection.execute(text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'"))
+                    function(connection, schema_name)
+                    save_version(connection, schema_name, version)
+                    publish_ddl(connection, schema_name, None, get_schema_version(schema_name) + 1)
+                result['applied'] += 1
+                result['version'] = version
+                bump_schema_version(schema_name)
+            except Exception as e:
+                logger.warning("Migration %s of %s failed: %s", version, schema_name, e)
+                with connection.begin():
+                    save_version(connection, schema_name, result['version'], 'failed',
+                                 f"{version} {description}: {e}")
+                result['status'] = 'failed'
+                result['error'] = str(e)
+                return result
+    return result
+
+def run_migrations(schemas:list = None, workers:int = MIGRATION_WORKERS,
+                   target:int = LATEST_VERSION) -> list:
+    """
+        Migrate every tenant schema (or the given schemas) in parallel
+    """
+    if schemas is None:
+        schemas = get_tenant_schemas()
+    SchemaMigrations.__table__.create(engine, checkfirst=True)
+    Jobs.__table__.create(engine, checkfirst=True)
+    # Concurrent CREATE EXTENSION fail, create them before the workers
+    create_extensions()
+    migration_engine = get_migration_engine(workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='migration') as executor:
+            results = list(executor.map(lambda schema_name: migrate_schema(migration_engine,
+                                                                           schema_name, target),
+                                        schemas))
+    finally:
+        migration_engine.dispose()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate the tenant schemas')
+    parser.add_argument('--workers', type=int, default=MIGRATION_WORKERS)
+    parser.add_argument('--schema', action='append', help='only migrate this schema')
+    parser.add_argument('--target', type=int, default=LATEST_VERSION)
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = run_migrations(args.schema, args.workers, args.target)
+    for status in ('done', 'locked', 'failed'):
+        schemas = [result['schema'] for result in results if result['status'] == status]
+        print(f"{status}: {len(schemas)}")
+        if status != 'done':
+            for schema_name in schemas:
+                print(f"  {schema_name}")
+    print(f"applied {sum(result['applied'] for result in results)} migrations "
+          f"in {time.perf_counter() - start:.2f}s")
+    if any(result['status'] == 'failed' for result in results):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -76,4 +76,42 @@ class Types(Base):
     updated_at = Column(DateTime(timezone=False),
                          default=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
     extra_backwards = relationship('Extras',
-                                   back_populates='type_model')
\ No newline at end of file
+                                   back_populates='type_model')
+
+class Jobs(Base):
+    """
+        Provisioning and teardown of the tenant schemas, they run in background
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = {"schema": "administration"}
+    id = Column(Integer, primary_key=True, index=True)
+    # create_country or delete_country
+    kind = Column(String, nullable=False)
+    # pending, running, done or failed
+    status = Column(String, nullable=False, default='pending', index=True)
+    country_id = Column(Integer, nullable=True)
+    country_alias = Column(String, nullable=True)
+    schema_name = Column(String, nullable=False)
+    error = Column(String, nullable=True)
+    started_at = Column(DateTime(timezone=False), nullable=True)
+    finished_at = Column(DateTime(timezone=False), nullable=True)
+    created_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
+    updated_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+                         onupdate=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
+
+class SchemaMigrations(Base):
+    """
+        Migration version of each tenant schema
+    """
+    __tablename__ = 'schema_migrations'
+    __table_args__ = {"schema": "administration"}
+    schema_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    # done or failed (the migration after version failed)
+    status = Column(String, nullable=False, default='done')
+    error = Column(String, nullable=True)
+    updated_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+                         onupdate=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
@@ -1,12 +1,19 @@
 """
     This file will contains the models for each country schema.
 """
-import datetime, re
-from sqlalchemy import (Column, Integer, String, Boolean, JSON, ForeignKey, DateTime, text)
+import os, time, datetime, re, functools, logging
+from sqlalchemy import (Column, Integer, String, Boolean, JSON, ForeignKey, DateTime, text,
+                        update, select)
+from sqlalchemy.schema import (CreateTable, CreateIndex)
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import (relationship, Session)
-from database.database import (Base, engine)
+from sqlalchemy.exc import OperationalError
+from database.database import (Base, engine, tenant_session)
 from database.models_admin import Types
+from database.cache import (bump_schema_version, get_schema_version, HIDDEN_PREFIX)
+from database.notify import publish_ddl
+
+logger = logging.getLogger(__name__)
 # Define a dictionary for common types
 COMMON_TYPES = {
     "char": "VARCHAR(255)",
@@ -21,6 +28,63 @@ COMMON_TYPES = {
     "time": "TIME"
 }
 
+# Index method for each index type of the extras, trigram needs pg_trgm
+INDEX_TYPES = {
+    "btree": "btree ({column})",
+    "hash": "hash ({column})",
+    "trigram": "gin ({column} gin_trgm_ops)",
+}
+# Types that can use a trigram index
+TEXT_TYPES = ("char", "text")
+# Status of the type changes that are not finished
+TYPE_CHANGE_ACTIVE = ("pending", "backfilling", "swapping")
+# The swap of the columns waits at most this time for the lock of the table
+SWAP_LOCK_TIMEOUT = os.getenv("SWAP_LOCK_TIMEOUT", "2s")
+SWAP_RETRIES = int(os.getenv("SWAP_RETRIES", 5))
+# A type change without progress in this time was stopped by a restart
+TYPE_CHANGE_STALE = float(os.getenv("TYPE_CHANGE_STALE", 300))
+# The drop of a hidden column waits at most this time for the lock of the table
+DROP_LOCK_TIMEOUT = os.getenv("DROP_LOCK_TIMEOUT", "1s")
+DROP_MAX_ATTEMPTS = int(os.getenv("DROP_MAX_ATTEMPTS", 20))
+# Indexes of the extras search, trigram for the texts and btree for the ids
+SEARCH_INDEXES = {
+    "ix_extras_name_trgm": "extras USING gin (name gin_trgm_ops)",
+    "ix_extras_display_name_trgm": "extras USING gin (display_name gin_trgm_ops)",
+    "ix_extras_brand_id": "extras (brand_id)",
+    "ix_extras_type_id": "extras (type_id)",
+}
+
+def parse_bool(value:str) -> bool:
+    """
+        Parse a boolean value of a query string
+    """
+    if value.lower() in ('true', 't', '1', 'yes'):
+        return True
+    if value.lower() in ('false', 'f', '0', 'no'):
+        return False
+    raise ValueError(f"{value} is not a boolean")
+
+# Parser of the values sent as string for the python type of each type in COMMON_TYPES
+TYPE_PARSERS = {
+    str: str,
+    int: int,
+    float: float,
+    bool: parse_bool,
+    datetime.date: datetime.date.fromisoformat,
+    datetime.datetime: datetime.datetime.fromisoformat,
+    datetime.time: datetime.time.fromisoformat,
+}
+
+def coerce_value(column, value:str):
+    """
+        Convert a string to the type of the column, raise ValueError if it is invalid
+    """
+    try:
+        parser = TYPE_PARSERS.get(column.type.python_type, str)
+    except NotImplementedError:
+        parser = str
+    return parser(value)
+
 class MultiTenantBase(object):
     """
         Class to set the schema properties of the base class
@@ -45,6 +109,11 @@ class Extras(MultiTenantBase, Base):
     type_id = Column(Integer, ForeignKey('administration.types.id', ondelete="CASCADE"))
     brand_id = Column(Integer, ForeignKey('brand.id', ondelete="CASCADE"))
     fixable = Column(Boolean, default=True, nullable=False)
+    # Index of the column: btree, trigram or hash and its build status
+    # (pending, building, ready or failed)
+    indexed = Column(Boolean, default=False, nullable=False)
+    index_type = Column(String, nullable=True)
+    index_status = Column(String, nullable=True)
     #countries = Column(JSON) # Validate this field with pydantic in a way that only countries_id
     brand = relationship('Brand', back_populates='extra_backwards')
     type_model = relationship('Types', back_populates='extra_backwards')
@@ -53,6 +122,46 @@ class Extras(MultiTenantBase, Base):
     updated_at = Column(DateTime(timezone=False),
                          default=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
 
+class ExtraTypeChange(MultiTenantBase, Base):
+    """
+        Progress of the online type change of an extra column
+    """
+    __tablename__ = 'extras_type_change'
+    id = Column(Integer, primary_key=True, index=True)
+    extra_id = Column(Integer, ForeignKey('extras.id', ondelete="CASCADE"))
+    type_id = Column(Integer, ForeignKey('administration.types.id', ondelete="CASCADE"))
+    # pending, backfilling, swapping, done or failed
+    status = Column(String, nullable=False, default='pending')
+    batch_size = Column(Integer, nullable=False, default=1000)
+    # Last id of the brand table copied to the shadow column
+    last_id = Column(Integer, nullable=False, default=0)
+    processed = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
+    updated_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+                         onupdate=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
+
+class ExtraTombstone(MultiTenantBase, Base):
+    """
+        Column of a deleted extra, it is hidden until the maintenance worker drops it
+    """
+    __tablename__ = 'extras_tombstone'
+    id = Column(Integer, primary_key=True, index=True)
+    table_name = Column(String, nullable=False)
+    column_name = Column(String, nullable=False)
+    # pending, dropped or failed
+    status = Column(String, nullable=False, default='pending', index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=True)
+    next_attempt_at = Column(DateTime(timezone=False), nullable=True)
+    created_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
+    updated_at = Column(DateTime(timezone=False),
+                         default=lambda: datetime.datetime.now(tz=datetime.timezone.utc),
+                         onupdate=lambda: datetime.datetime.now(tz=datetime.timezone.utc))
+
 class Brand(MultiTenantBase,Base):
     """
         Model for each brand of car
@@ -86,67 +195,160 @@ class Chevrolet(MultiTenantBase, Base):
     user_id = Column(Integer, ForeignKey(f'administration.users.id', ondelete="CASCADE"))
     model = Column(String, nullable=True)
     
-def create_schema(schema_name:str, db):
+def create_schema(schema_name:str, db = None):
     """
-        Create schema
+        Create the schema of a tenant with its tables, indexes and default brands.
+        The script is rendered once from the template (see get_schema_script) and
+        runs in a single transaction, so a tenant is never half created
     """
-    # Create schema if it does not exist
-    with engine.connect() as connection:
-        # connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema_name}"))
+    bind = db.get_bind() if db is not None else engine
+    # Only checked once per process, a missing extension does not stop the schema
+    create_extensions(bind)
+    try:
+        with bind.begin() as connection:
+            script = get_schema_script().replace(TEMPLATE_SCHEMA, schema_name)
+            connection.execution_options(no_parameters=True).exec_driver_sql(script)
+            publish_ddl(connection, schema_name, None, get_schema_version(schema_name) + 1)
+    except Exception as e:
+        logger.exception("Error creating schema %s", schema_name)
+        raise Exception(str(e))
+    bump_schema_version(schema_name)
+
+def create_extensions(bind = None) -> set:
+    """
+        Create the extensions of the tenant schemas once per process and return the
+        installed ones. Concurrent CREATE EXTENSION fail with a unique violation so
+        they wait for a lock. An extension that is not available is logged and the
+        features that use it are disabled, the schemas are created without it
+    """
+    global _extensions
+    if _extensions is not None:
+        return _extensions
+    bind = bind if bind is not None else engine
+    installed = set()
+    for extension in EXTENSIONS:
         try:
-            connection.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema_name}"))
-            connection.commit()
-            result = connection.execute(text(f"SELECT schema_name FROM information_schema.schemata WHERE schema_name = '{schema_name}'"))
-            result = result.fetchone()
-            if result is not None:
-                create_tables(schema_name)
-                add_default_values(schema_name,db)
-            else:
-                raise Exception(f"Error cannot created schema {schema_name}")
-        except Exception as e:
-            print(f"Error creating schema: {e}")
-            raise Exception(str(e))
+            with bind.begin() as connection:
+                connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('tenant_extensions'))"))
+                exists = connection.execute(text("SELECT 1 FROM pg_extension WHERE extname = :name"),
+                                            {'name': extension}).first()
+                if exists is None:
+                    available = connection.execute(
+                        text("SELECT 1 FROM pg_available_extensions WHERE name = :name"),
+                        {'name': extension}).first()
+                    if available is None:
+                        logger.warning("Extension %s is not available", extension)
+                        continue
+                    connection.execute(text(f"CREATE EXTENSION IF NOT EXISTS {extension}"))
+            installed.add(extension)
+        except Exception:
+            logger.exception("Error creating the extension %s", extension)
+    _extensions = installed
+    return installed
 
-def delete_schema(schema_name:str):
+def has_extension(extension:str) -> bool:
+    """
+        Check if an extension of the tenant schemas is installed
+    """
+    return extension in create_extensions()
+
+def get_search_indexes() -> dict:
+    """
+        Return the indexes of the extras search, the trigram ones need pg_trgm
+    """
+    trigram = has_extension("pg_trgm")
+    return {index_name: definition for index_name, definition in SEARCH_INDEXES.items()
+            if trigram or "gin_trgm_ops" not in definition}
+
+def get_schema_script() -> str:
+    """
+        Render the ddl and the default values of a tenant schema as one script, the
+        name of the schema is TEMPLATE_SCHEMA. The tables are not qualified, they
+        are created in the schema of the search path of the transaction
+    """
+    return render_schema_script(tuple(get_search_indexes().items()))
+
+@functools.lru_cache(maxsize=2)
+def render_schema_script(search_indexes:tuple) -> str:
+    """
+        Render the script of get_schema_script with the given search indexes
+    """
+    statements = [f"CREATE SCHEMA IF NOT EXISTS {TEMPLATE_SCHEMA}",
+                  f"SET LOCAL search_path TO {TEMPLATE_SCHEMA}, public"]
+    for table in Base.metadata.sorted_tables:
+        if table not in TENANT_TABLES:
+            continue
+        statements.append(str(CreateTable(table, if_not_exists=True).compile(dialect=engine.dialect)))
+        for index in sorted(table.indexes, key=lambda index: [column.name for column in index.columns]):
+            statements.append(str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect)))
+    for index_name, definition in search_indexes:
+        statements.append(f"CREATE INDEX IF NOT EXISTS {index_name} ON {definition}")
+    now = "now() AT TIME ZONE 'utc'"
+    for brand in DEFAULT_BRANDS:
+        statements.append(
+            f"INSERT INTO brand (name, display_name, foundation_year, created_at, updated_at) "
+            f"SELECT '{brand['name']}', '{brand['display_name']}', {brand['foundation_year']}, "
+            f"{now}, {now} WHERE NOT EXISTS (SELECT 1 FROM brand WHERE name = '{brand['name']}')")
+    return ";\n".join(statements) + ";"
+
+def delete_schema(schema_name:str, bind = None):
     """
         Create schema
     """
+    bind = bind if bind is not None else engine
     # Create schema if it does not exist
-    with engine.connect() as connection:
+    with bind.connect() as connection:
         connection.execute(text(f"DROP SCHEMA IF EXISTS {schema_name} CASCADE"))
+        publish_ddl(connection, schema_name, None, get_schema_version(schema_name) + 1)
         connection.commit()
         result = connection.execute(text(f"SELECT schema_name FROM information_schema.schemata WHERE schema_name = '{schema_name}'"))
         if result.fetchone() is not None:
             raise Exception(f"Error cannot deleted schema {schema_name}")
+    bump_schema_version(schema_name)
     
 
 
+# Extensions used by the tenant schemas (trigram indexes)
+EXTENSIONS = ("pg_trgm",)
+# Installed extensions, they are checked once per process (see create_extensions)
+_extensions = None
+# Tables of each tenant schema
+TENANT_TABLES = [Extras.__table__, Brand.__table__, Toyota.__table__, Chevrolet.__table__,
+                 Ford.__table__, ExtraTypeChange.__table__, ExtraTombstone.__table__]
+# Name of the schema in the rendered script, it is replaced by the tenant schema
+TEMPLATE_SCHEMA = "tenant_template_schema"
+DEFAULT_BRANDS = [
+    {'name': 'toyota', 'display_name': 'Toyota', 'foundation_year': 1937},
+    {'name': 'ford', 'display_name': 'Ford', 'foundation_year': 1903},
+    {'name': 'chevrolet', 'display_name': 'Chevrolet', 'foundation_year': 1911},
+]
+
 def create_tables(schema_name):
-    # Create tables in the specified schema
-    Extras.__table__.schema = schema_name
-    Brand.__table__.schema = schema_name
-    Toyota.__table__.schema = schema_name
-    Chevrolet.__table__.schema = schema_name
-    Ford.__table__.schema = schema_name
-
-    Base.metadata.create_all(bind=engine, tables=[Extras.__table__, Brand.__table__,
-                                                  Toyota.__table__, Chevrolet.__table__,
-                                                  Ford.__table__, ])
+    # Create tables in the specified schema, the tenant tables do not have schema
+    # so they are rendered inside the schema without changing the models
+    schema_engine = engine.execution_options(schema_translate_map={None: schema_name})
+    Base.metadata.create_all(bind=schema_engine, tables=TENANT_TABLES)
+    create_search_indexes(schema_name)
+
+def create_search_indexes(schema_name:str):
+    """
+        Create the indexes used by the search of the extras
+    """
+    with engine.begin() as connection:
+        for index_name, definition in get_search_indexes().items():
+            connection.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} "
+                                    f"ON {schema_name}.{definition}"))
 def add_default_values(schema_name:str, db):
     """
         Create dfefault values for brands and extras
     """
     # Add default brands
-    brands  = [{'name': 'toyota', 'display_name': 'Toyota',
-                    'foundation_year': 1937},{'name': 'ford', 'display_name': 'Ford',
-                    'foundation_year': 1903}, {'name': 'chevrolet', 'display_name': 'Chevrolet',
-                    'foundation_year': 1911}]
-    MultiTenantBase.set_schema(schema_name)
-    for brand in brands:
-        obj = Brand(**brand)
-        db.add(obj)
-        db.commit()
-        db.refresh(obj)
+    tenant_db = tenant_session(schema_name, bind=db.get_bind())
+    try:
+        tenant_db.add_all([Brand(**brand) for brand in DEFAULT_BRANDS])
+        tenant_db.commit()
+    finally:
+        tenant_db.close()
 
 async def add_column(extra:Extras, db:Session):
     """
@@ -156,41 +358,368 @@ async def add_column(extra:Extras, db:Session):
     pg_column_type = COMMON_TYPES.get(extra.type_model.name, "VARCHAR(255)")  # Default to VARCHAR(255) if type not found
     table_name = extra.brand.name # This name must be formated correctly to work as a table name
     column_name = clean_string(extra.name)
+    schema_name = get_session_schema(db, table_name)
     # Add new column to Brand model
     sql_command = f"""
-    ALTER TABLE {table_name}
+    ALTER TABLE {schema_name}.{table_name}
     ADD COLUMN {column_name} {pg_column_type};
     """
     db.execute(text(sql_command))
-    db.commit()
+    commit_ddl(db, schema_name, table_name)
+
+async def add_columns(extras:list, db:Session, renamed:list = None):
+    """
+        Add the columns of many extras in one transaction, the new columns of each
+        table are added with a single ALTER TABLE. renamed is a list of
+        (previous name, extra) of the edited extras
+    """
+    schema_name = None
+    # The renames go first, a new column could use the previous name
+    for previous_name, extra in renamed or []:
+        schema_name = rename_column(previous_name, extra, db)
+    tables = {}
+    for extra in extras:
+        tables.setdefault(extra.brand.name, []).append(extra)
+    for table_name, table_extras in tables.items():
+        schema_name = get_session_schema(db, table_name)
+        clauses = ", ".join(
+            f"ADD COLUMN {clean_string(extra.name)} "
+            f"{COMMON_TYPES.get(extra.type_model.name, 'VARCHAR(255)')}"
+            for extra in table_extras)
+        db.execute(text(f"ALTER TABLE {schema_name}.{table_name} {clauses}"))
+    if schema_name is None:
+        db.commit()
+        return
+    commit_ddl(db, schema_name, None)
 
 async def modify_column(previous_name:str,extra:Extras, db:Session):
     """
         modify only the name of the column
     """
+    schema_name = rename_column(previous_name, extra, db)
+    commit_ddl(db, schema_name, extra.brand.name)
+
+def rename_column(previous_name:str, extra:Extras, db:Session) -> str:
+    """
+        Rename the column (and its index) of an extra without commit, return the schema
+    """
     table_name = extra.brand.name # This name must be formated correctly to work as a table name
     new_column_name = clean_string(extra.name)
-    # Add new column to Brand model
-    sql_command = f"""
-    ALTER TABLE {table_name}
-    RENAME COLUMN {previous_name} TO {new_column_name};
-    """
-    db.execute(text(sql_command))
-    db.commit()
+    schema_name = get_session_schema(db, table_name)
+    if previous_name != new_column_name:
+        # Add new column to Brand model
+        sql_command = f"""
+        ALTER TABLE {schema_name}.{table_name}
+        RENAME COLUMN {previous_name} TO {new_column_name};
+        """
+        db.execute(text(sql_command))
+        # The index keeps the name of the column
+        db.execute(text(f"ALTER INDEX IF EXISTS {schema_name}.{get_index_name(table_name, previous_name)} "
+                        f"RENAME TO {get_index_name(table_name, new_column_name)}"))
+    return schema_name
 
 async def drop_column(extra:Extras, db:Session):
     """
-        modify only the name of the column
+        Hide the column of the extra without locking the table, it is not reflected
+        anymore and the maintenance worker drops it later (see purge_dropped_columns)
     """
     table_name = extra.brand.name # This name must be formated correctly to work as a table name
     column_name = clean_string(extra.name)
-    # Add new column to Brand model
-    sql_command = f"""
-    ALTER TABLE {table_name}
-    DROP COLUMN {column_name};
+    schema_name = get_session_schema(db, table_name)
+    db.add(ExtraTombstone(table_name=table_name, column_name=column_name))
+    commit_ddl(db, schema_name, table_name)
+
+def get_dropped_columns(schema_name:str, table_name:str) -> set:
     """
-    db.execute(text(sql_command))
+        Return the columns of the table that are hidden waiting to be dropped
+    """
+    db = tenant_session(schema_name)
+    try:
+        query = select(ExtraTombstone.column_name).where(ExtraTombstone.table_name == table_name,
+                                                         ExtraTombstone.status != 'dropped')
+        return set(db.scalars(query).all())
+    finally:
+        db.close()
+
+def purge_dropped_columns(schema_name:str) -> int:
+    """
+        Drop the hidden columns of a schema. Each drop waits at most DROP_LOCK_TIMEOUT
+        for the lock of the table, otherwise it is retried later with backoff
+    """
+    db = tenant_session(schema_name)
+    dropped = 0
+    try:
+        now = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+        tombstones = db.query(ExtraTombstone).filter(
+            ExtraTombstone.status == 'pending',
+            (ExtraTombstone.next_attempt_at == None) | (ExtraTombstone.next_attempt_at <= now)
+        ).order_by(ExtraTombstone.id).all()
+        db.commit()
+        for tombstone in tombstones:
+            try:
+                # Other worker could be dropping the same column
+                locked = db.execute(text("SELECT pg_try_advisory_xact_lock(hashtext(:key))"),
+                                    {'key': f"{schema_name}.{tombstone.table_name}"
+                                            f".{tombstone.column_name}"}).scalar()
+                if not locked:
+                    db.rollback()
+                    continue
+                db.execute(text(f"SET LOCAL lock_timeout = '{DROP_LOCK_TIMEOUT}'"))
+                db.execute(text(f"ALTER TABLE {schema_name}.{tombstone.table_name} "
+                                f"DROP COLUMN IF EXISTS {tombstone.column_name}"))
+                tombstone.status = 'dropped'
+                db.commit()
+                dropped += 1
+            except Exception as e:
+                db.rollback()
+                tombstone.attempts = tombstone.attempts + 1
+                tombstone.error = str(e)
+                tombstone.next_attempt_at = now + datetime.timedelta(
+                    seconds=min(2 ** tombstone.attempts, 3600))
+                if tombstone.attempts >= DROP_MAX_ATTEMPTS:
+                    tombstone.status = 'failed'
+                db.commit()
+    finally:
+        db.close()
+    return dropped
+
+def get_index_name(table_name:str, column_name:str) -> str:
+    """
+        Return the name of the index of an extra column
+    """
+    return f"ix_extra_{table_name}_{column_name}"[:63]
+
+def set_index_status(schema_name:str, extra_id:int, status:str):
+    """
+        Save the build status of the index of an extra
+    """
+    db = tenant_session(schema_name)
+    try:
+        db.execute(update(Extras).where(Extras.id == extra_id).values(index_status=status))
+        db.commit()
+    finally:
+        db.close()
+
+def build_extra_index(schema_name:str, extra_id:int):
+    """
+        Create (or remove) the index of an extra with CONCURRENTLY, so the brand
+        table can be written while it is built. It runs outside of the request
+    """
+    db = tenant_session(schema_name)
+    try:
+        extra = db.get(Extras, extra_id)
+        if extra is None:
+            return
+        table_name = extra.brand.name
+        column_name = clean_string(extra.name)
+        indexed, index_type = extra.indexed, extra.index_type or "btree"
+        # CONCURRENTLY waits for the open transactions, do not keep this one
+        db.commit()
+    finally:
+        db.close()
+    index_name = f"{schema_name}.{get_index_name(table_name, column_name)}"
+    try:
+        # CONCURRENTLY cannot run inside a transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            # Remove the previous index (or an invalid one of a failed build)
+            connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name}"))
+            if not indexed:
+                set_index_status(schema_name, extra_id, None)
+                return
+            set_index_status(schema_name, extra_id, "building")
+            if index_type == "trigram" and not has_extension("pg_trgm"):
+                raise Exception("trigram indexes need the pg_trgm extension")
+            method = INDEX_TYPES[index_type].format(column=column_name)
+            connection.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS "
+                                    f"{get_index_name(table_name, column_name)} "
+                                    f"ON {schema_name}.{table_name} USING {method}"))
+        set_index_status(schema_name, extra_id, "ready")
+    except Exception:
+        # The maintenance builds the failed indexes again (see retry_failed_indexes)
+        logger.exception("Error building index %s", index_name)
+        set_index_status(schema_name, extra_id, "failed")
+
+def retry_failed_indexes(schema_name:str) -> int:
+    """
+        Build again the indexes of the extras whose last build failed, return the
+        number of builds
+    """
+    db = tenant_session(schema_name)
+    try:
+        extra_ids = db.execute(select(Extras.id).where(Extras.index_status == "failed")
+                               .order_by(Extras.id)).scalars().all()
+    finally:
+        db.close()
+    for extra_id in extra_ids:
+        build_extra_index(schema_name, extra_id)
+    return len(extra_ids)
+
+def change_column_type(schema_name:str, change_id:int):
+    """
+        Change the type of an extra column without locking the brand table. A shadow
+        column is kept in sync by a trigger while it is backfilled in batches (each
+        one in its own transaction) and at the end both columns are swapped.
+        The progress is saved in the ExtraTypeChange, so a stopped change resumes
+        (see resume_type_changes)
+    """
+    db = tenant_session(schema_name)
+    table_name = column_name = None
+    try:
+        change = db.get(ExtraTypeChange, change_id)
+        extra = db.get(Extras, change.extra_id)
+        extra_id, indexed = extra.id, extra.indexed
+        pg_column_type = COMMON_TYPES.get(db.get(Types, change.type_id).name, "VARCHAR(255)")
+        table_name = extra.brand.name
+        column_name = clean_string(extra.name)
+        shadow_name = f"{HIDDEN_PREFIX}{column_name}"
+        function_name = f"{schema_name}.sync_{table_name}_{column_name}"
+        trigger_name = f"sync_{table_name}_{column_name}"
+        if change.status == "pending":
+            # Every write of the rows copies the value to the shadow column, a value
+            # that cannot be converted is saved as null instead of failing the write
+            run_ddl_with_retry(db, schema_name, table_name, [
+                f"ALTER TABLE {schema_name}.{table_name} "
+                f"ADD COLUMN IF NOT EXISTS {shadow_name} {pg_column_type}",
+                f"""
+                CREATE OR REPLACE FUNCTION {function_name}() RETURNS trigger AS $$
+                BEGIN
+                    NEW.{shadow_name} := CAST(CAST(NEW.{column_name} AS TEXT) AS {pg_column_type});
+                    RETURN NEW;
+                EXCEPTION WHEN others THEN
+                    NEW.{shadow_name} := NULL;
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+                """,
+                f"DROP TRIGGER IF EXISTS {trigger_name} ON {schema_name}.{table_name}",
+                f"CREATE TRIGGER {trigger_name} BEFORE INSERT OR UPDATE "
+                f"ON {schema_name}.{table_name} FOR EACH ROW EXECUTE FUNCTION {function_name}()",
+            ], lambda: setattr(change, "status", "backfilling"))
+        while change.status == "backfilling":
+            # The existing values must be valid, the cast of the update fails otherwise
+            ids = db.execute(text(f"""
+            WITH batch AS (
+                SELECT id FROM {schema_name}.{table_name}
+                WHERE id > :last_id ORDER BY id LIMIT :batch_size
+            )
+            UPDATE {schema_name}.{table_name} AS element
+            SET {shadow_name} = CAST(CAST(element.{column_name} AS TEXT) AS {pg_column_type})
+            FROM batch WHERE element.id = batch.id
+            RETURNING element.id
+            """), {"last_id": change.last_id, "batch_size": change.batch_size}).scalars().all()
+            if len(ids) == 0:
+                change.status = "swapping"
+            else:
+                change.last_id = max(ids)
+                change.processed = change.processed + len(ids)
+            db.commit()
+
+        def swap():
+            extra.type_id = change.type_id
+            # The index was dropped with the old column
+            if indexed:
+                extra.index_status = "pending"
+            change.status = "done"
+        run_ddl_with_retry(db, schema_name, table_name, [
+            f"DROP TRIGGER IF EXISTS {trigger_name} ON {schema_name}.{table_name}",
+            f"DROP FUNCTION IF EXISTS {function_name}()",
+            f"ALTER TABLE {schema_name}.{table_name} DROP COLUMN {column_name}",
+            f"ALTER TABLE {schema_name}.{table_name} RENAME COLUMN {shadow_name} TO {column_name}",
+        ], swap)
+    except Exception as e:
+        db.rollback()
+        logger.exception("Error changing the type of %s.%s", table_name, column_name)
+        if column_name is None:
+            db.query(ExtraTypeChange).filter(ExtraTypeChange.id == change_id)\
+                .update({"status": "failed", "error": str(e)})
+            db.commit()
+            return
+
+        def fail():
+            change.status = "failed"
+            change.error = str(e)
+        try:
+            # Remove the shadow column, the old column is not changed
+            run_ddl_with_retry(db, schema_name, table_name, [
+                f"DROP TRIGGER IF EXISTS {trigger_name} ON {schema_name}.{table_name}",
+                f"DROP FUNCTION IF EXISTS {function_name}()",
+                f"ALTER TABLE {schema_name}.{table_name} DROP COLUMN IF EXISTS {shadow_name}",
+            ], fail)
+        except Exception:
+            # The change keeps its status, resume_type_changes tries again later
+            logger.exception("Error removing the shadow column of %s.%s", table_name, column_name)
+            db.rollback()
+            change.error = str(e)
+            db.commit()
+        return
+    finally:
+        db.close()
+    if indexed:
+        build_extra_index(schema_name, extra_id)
+
+def run_ddl_with_retry(db:Session, schema_name:str, table_name:str, statements:list,
+                       apply=None):
+    """
+        Run ddl statements in one transaction that waits at most SWAP_LOCK_TIMEOUT
+        for the lock of the table, it is tried SWAP_RETRIES times with backoff.
+        apply changes the orm objects before the commit
+    """
+    for attempt in range(SWAP_RETRIES):
+        try:
+            db.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+            for statement in statements:
+                db.execute(text(statement))
+            if apply is not None:
+                apply()
+            commit_ddl(db, schema_name, table_name)
+            return
+        except OperationalError:
+            # Timeout waiting for the lock, try again later
+            db.rollback()
+            time.sleep(2 ** attempt)
+    raise Exception(f"cannot lock {table_name}")
+
+def resume_type_changes(schema_name:str) -> int:
+    """
+        Resume the type changes stopped by a restart, a change is stopped when its
+        progress was not saved in TYPE_CHANGE_STALE seconds
+    """
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    db = tenant_session(schema_name)
+    try:
+        # The update claims the changes, other worker does not resume them
+        change_ids = db.execute(
+            update(ExtraTypeChange)
+            .where(ExtraTypeChange.status.in_(TYPE_CHANGE_ACTIVE),
+                   ExtraTypeChange.updated_at < now - datetime.timedelta(seconds=TYPE_CHANGE_STALE))
+            .values(updated_at=now).returning(ExtraTypeChange.id)).scalars().all()
+        db.commit()
+    finally:
+        db.close()
+    for change_id in change_ids:
+        change_column_type(schema_name, change_id)
+    return len(change_ids)
+
+def commit_ddl(db:Session, schema_name:str, table_name:str):
+    """
+        Commit a ddl change, publish it to the other workers and invalidate the cache
+    """
+    publish_ddl(db, schema_name, table_name, get_schema_version(schema_name) + 1)
     db.commit()
+    bump_schema_version(schema_name)
+
+def get_session_schema(db:Session, table_name:str):
+    """
+        Return the tenant schema of the session, tenant sessions save it in the
+        session info, otherwise resolve the table with the search path
+    """
+    schema_name = db.info.get('schema_name')
+    if schema_name is None:
+        result = db.execute(text("SELECT relnamespace::regnamespace::text FROM pg_class "
+                                 "WHERE oid = to_regclass(:table_name)"),
+                            {'table_name': table_name})
+        schema_name = result.scalar()
+    return schema_name
 
 def clean_string(input_str):
     # Convert to lowercase
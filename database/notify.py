@@ -0,0 +1,131 @@
+"""
+    Share the ddl changes between the workers with Postgres LISTEN/NOTIFY
+"""
+import os, json, uuid, select, threading, logging
+from sqlalchemy import (text, create_engine)
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+from database.database import (engine, is_transaction_pooler)
+from database.cache import (bump_schema_version, clear_cache, invalidate_tenant,
+                            invalidate_principal)
+
+CHANNEL = 'tenant_ddl'
+# Seconds to wait for a notification before checking if the listener must stop
+POLL_TIMEOUT = 5
+# LISTEN needs its own server connection, behind a transaction pooler set the url of
+# a direct connection to postgres
+DB_LISTEN_URL = os.getenv('DB_LISTEN_URL')
+# Id of this process in the notifications, the pids of workers in other hosts
+# or containers can be the same
+SENDER_ID = uuid.uuid4().hex
+logger = logging.getLogger(__name__)
+_stop = threading.Event()
+_thread = None
+
+def publish_ddl(db:Session, schema_name:str, table_name:str, version:int):
+    """
+        Publish a ddl change, the notification is delivered when the transaction commit
+    """
+    payload = json.dumps({'schema': schema_name, 'table': table_name,
+                          'version': version, 'sender': SENDER_ID})
+    db.execute(text("SELECT pg_notify(:channel, :payload)"),
+               {'channel': CHANNEL, 'payload': payload})
+
+def publish_tenant(db:Session, country_alias:str):
+    """
+        Publish that a country was created or deleted
+    """
+    payload = json.dumps({'alias': country_alias, 'sender': SENDER_ID})
+    db.execute(text("SELECT pg_notify(:channel, :payload)"),
+               {'channel': CHANNEL, 'payload': payload})
+
+def publish_principal(db:Session, key = None):
+    """
+        Publish that the principal of a user changed (all principals if it is None)
+    """
+    payload = json.dumps({'principal': key, 'sender': SENDER_ID})
+    db.execute(text("SELECT pg_notify(:channel, :payload)"),
+               {'channel': CHANNEL, 'payload': payload})
+
+def handle_notification(payload:str):
+    """
+        Evict the local caches of the schema changed by other worker
+    """
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        logger.warning("Invalid ddl notification %s", payload)
+        return
+    if data.get('sender') == SENDER_ID:
+        # This worker already invalidated its cache
+        return
+    schema_name = data.get('schema')
+    if schema_name:
+        bump_schema_version(schema_name)
+    country_alias = data.get('alias')
+    if country_alias:
+        invalidate_tenant(country_alias)
+    if 'principal' in data:
+        invalidate_principal(data['principal'])
+
+def listen():
+    """
+        Wait for notifications until the listener is stopped, reconnect on errors
+    """
+    backoff = 1
+    listen_engine = create_engine(DB_LISTEN_URL, poolclass=NullPool) if DB_LISTEN_URL else engine
+    while not _stop.is_set():
+        connection = None
+        try:
+            connection = listen_engine.raw_connection()
+            # The connection is only used to listen, do not return it to the pool
+            connection.detach()
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"LISTEN {CHANNEL}")
+            # Notifications could be lost while disconnected
+            clear_cache()
+            invalidate_tenant()
+            invalidate_principal()
+            backoff = 1
+            while not _stop.is_set():
+                if select.select([dbapi_connection], [], [], POLL_TIMEOUT) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    handle_notification(notification.payload)
+        except Exception as e:
+            logger.warning("Ddl listener error %s, reconnecting in %s seconds", e, backoff)
+            _stop.wait(backoff)
+            backoff = min(backoff * 2, 60)
+        finally:
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+
+def start_listener():
+    """
+        Start the listener thread of this worker
+    """
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return _thread
+    if is_transaction_pooler() and not DB_LISTEN_URL:
+        logger.warning("DB_LISTEN_URL is required to listen ddl changes behind a transaction pooler")
+        return None
+    _stop.clear()
+    _thread = threading.Thread(target=listen, name='tenant-ddl-listener', daemon=True)
+    _thread.start()
+    return _thread
+
+def stop_listener():
+    """
+        Stop the listener thread
+    """
+    _stop.set()
+    if _thread is not None:
+        _thread.join(POLL_TIMEOUT + 1)
@@ -0,0 +1,89 @@
+"""
+    Password hashing in a bounded pool of workers, bcrypt takes tens of
+    milliseconds of cpu and must not run in the event loop
+"""
+import os, asyncio, threading
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor)
+from passlib.hash import bcrypt
+from fastapi import (HTTPException, status)
+
+# Cost of the new hashes, the hashes with other cost are updated on login
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# thread or process
+PASSWORD_EXECUTOR = os.getenv('PASSWORD_EXECUTOR', 'thread')
+PASSWORD_WORKERS = int(os.getenv('PASSWORD_WORKERS', os.cpu_count() or 1))
+# Jobs waiting for a worker, the requests over this limit are rejected with 429
+PASSWORD_QUEUE_SIZE = int(os.getenv('PASSWORD_QUEUE_SIZE', PASSWORD_WORKERS * 8))
+
+_slots = threading.BoundedSemaphore(PASSWORD_WORKERS + PASSWORD_QUEUE_SIZE)
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+        Return the pool of workers, it is created on the first use
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if PASSWORD_EXECUTOR == 'process':
+                _executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                               thread_name_prefix='password')
+    return _executor
+
+def _hash(password:str, rounds:int) -> str:
+    return bcrypt.using(rounds=rounds).hash(password)
+
+def _verify(password:str, password_hash:str) -> bool:
+    return bcrypt.verify(password, password_hash)
+
+async def run_password_job(function, *args):
+    """
+        Run the function in the pool, reject it if the queue is full
+    """
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many requests, try again later",
+                            headers={'Retry-After': '1'})
+    try:
+        future = get_executor().submit(function, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return await asyncio.wrap_future(future)
+
+async def hash_password(password:str) -> str:
+    """
+        Hash the password with the configured cost
+    """
+    return await run_password_job(_hash, password, BCRYPT_ROUNDS)
+
+async def verify_password(password:str, password_hash:str) -> bool:
+    """
+        Check if password match the hash
+    """
+    if not password_hash:
+        return False
+    return await run_password_job(_verify, password, password_hash)
+
+def needs_rehash(password_hash:str) -> bool:
+    """
+        Check if the hash was made with other cost ($2b$12$...)
+    """
+    try:
+        return int(password_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+def shutdown_executor():
+    """
+        Stop the pool of workers
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
@@ -1,14 +1,20 @@
 """
     File to save different function to call the db
 """
-import math
+import math, json, base64, binascii
+from sqlalchemy import (select, func)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.sql.expression import (Executable, ClauseElement)
 from fastapi import (HTTPException, Request, Depends, status)
 from fastapi.encoders import jsonable_encoder
 from database.models_admin import (Users, Roles, Countries)
-from database.models_countries import (format_schema, MultiTenantBase)
+from database.models_countries import format_schema
 from pydantic_models.pydantic_admin import (UserResponse, UserResponseRol, RolesResponse)
 from database.database import get_db
+from database.cache import (get_cached_principal, cache_principal, MISSING)
+from database.security import (verify_password, hash_password, needs_rehash)
 async def save_instance(model:any,db: Session):
     """
         Save a instance to the db
@@ -29,12 +35,11 @@ async def get_instance(model:any, db:Session, model_id: int, query=None, schema_
     """
         Function to retrive an instance of the db
     """
-    if schema_name is not None:
-        # Change the path of the schema
-        print('look up here')
-        MultiTenantBase.set_schema(schema_name)
     if query is None:
         query = db.query(model)
+    if schema_name is not None:
+        # Render the tenant tables inside the schema only for this query
+        query = query.execution_options(schema_translate_map={None: schema_name})
     instance = query.filter(model.id == model_id).first()
     return instance
 
@@ -58,8 +63,13 @@ async def get_user_authenticate(username:str, password:str, db:Session):
     if user is None:
         raise HTTPException(404, "User not found")
     # Check the password
-    if not user.check_password(password):
+    if not await verify_password(password, user.password_hash):
         raise HTTPException(422, "password incorrect")
+    if needs_rehash(user.password_hash):
+        # The configured cost changed, update the hash while the password is known
+        user.password_hash = await hash_password(password)
+        db.commit()
+        db.refresh(user)
     user_response = UserResponse.model_validate(user)
     return user_response
 
@@ -77,12 +87,16 @@ async def create_user_with_role(user_db: Users, db:Session):
 
 async def get_current_user(request: Request, db:Session = Depends(get_db)):
     """
-        Get current user
+        Get current user, the principal is cached for a short time
     """
     user = request.session.get('user')
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
-    
+    key = get_principal_key(user)
+    principal = get_cached_principal(key)
+    if principal is not MISSING:
+        return principal
+
     if 'id' in user:
         # user is in the db
         user_id = user['id']
@@ -90,14 +104,24 @@ async def get_current_user(request: Request, db:Session = Depends(get_db)):
         user = await get_instance(Users, db, user_id, query=query)
         if user is None:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-        return UserResponseRol.model_validate(user)
+        principal = UserResponseRol.model_validate(user)
     else:
         rol_id = user['role_id']
         rol_db = await get_instance(Roles, db, rol_id)
         rol_response = RolesResponse.model_validate(rol_db)
         user['rol'] = rol_response.model_dump(mode = 'json')
-        user = UserResponseRol(**user)
-        return user
+        principal = UserResponseRol(**user)
+    cache_principal(key, principal)
+    return principal
+
+def get_principal_key(user:dict):
+    """
+        Return the key of the session user in the principal cache, the user id or
+        the email and role for OAuth users (they are not saved in the db)
+    """
+    if 'id' in user:
+        return user['id']
+    return ('oauth', user.get('email'), user.get('role_id'))
 
 
 async def get_admin_user(current_user: UserResponseRol = Depends(get_current_user)):
@@ -134,4 +158,58 @@ async def paginated_query(query, page:int, page_size:int, offset:int):
         "page_size": page_size,
         "total_pages": total_pages,
         "data": results
-    }
\ No newline at end of file
+    }
+
+class Explain(Executable, ClauseElement):
+    """
+        EXPLAIN of a select, it runs like the select so the IN lists are expanded
+        and the tenant tables are rendered inside the schema of the session
+    """
+    inherit_cache = False
+
+    def __init__(self, query):
+        self.query = query
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.query, **kw)}"
+
+async def count_rows(query, db:Session, mode:str = 'exact'):
+    """
+        Return the number of rows of a select, estimate use the planner statistics
+        and none does not count
+    """
+    if mode == 'none':
+        return None
+    query = query.order_by(None)
+    if mode == 'estimate':
+        try:
+            # A failed EXPLAIN only rolls back the savepoint, not the request
+            with db.begin_nested():
+                plan = db.execute(Explain(query)).scalar()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        except (SQLAlchemyError, LookupError, TypeError, ValueError):
+            pass
+    return db.execute(select(func.count()).select_from(query.subquery())).scalar_one()
+
+def encode_cursor(data:dict) -> str:
+    """
+        Return an opaque cursor with the last id and the filters of the page
+    """
+    raw = json.dumps(data, separators=(',', ':'), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor:str) -> dict:
+    """
+        Return the data saved in a cursor
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (ValueError, binascii.Error) as e:
+        raise HTTPException(422, "Invalid cursor") from e
+    if not isinstance(data, dict) or not isinstance(data.get('id'), int):
+        raise HTTPException(422, "Invalid cursor")
+    return data
@@ -0,0 +1,61 @@
+"""
+    Async version of the functions in services, they use an AsyncSession so the
+    queries do not block the event loop
+"""
+import math
+from sqlalchemy import (select, func)
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import HTTPException
+from database.services import encode_cursor
+
+async def get_instance(model:any, db: AsyncSession, model_id: int, query=None, schema_name:str = None):
+    """
+        Function to retrive an instance of the db, query is a select of the model
+    """
+    if query is None:
+        query = select(model)
+    query = query.where(model.id == model_id)
+    if schema_name is not None:
+        # Render the tenant tables inside the schema only for this query
+        query = query.execution_options(schema_translate_map={None: schema_name})
+    result = await db.execute(query)
+    return result.scalars().first()
+
+async def paginated_query(query, db: AsyncSession, page:int, page_size:int, offset:int):
+    """
+        Paginated a select of a model and formated
+    """
+    count_query = select(func.count()).select_from(query.order_by(None).subquery())
+    total = (await db.execute(count_query)).scalar_one()
+    total_pages = math.ceil(total / page_size)
+    result = await db.execute(query.offset(offset).limit(page_size))
+    results = result.scalars().all()
+    if not results and page != 1 and total != 0:
+        raise HTTPException(status_code=404, detail="Page not found")
+    return {
+        "total": total,
+        "page": page,
+        "page_size": page_size,
+        "total_pages": total_pages,
+        "data": results
+    }
+
+async def keyset_query(query, db: AsyncSession, id_column, page_size:int, last_id:int = None,
+                       filters:dict = None):
+    """
+        Paginated a select ordered by id desc with a cursor, the cost of a page does
+        not depend on how deep it is
+    """
+    if last_id is not None:
+        query = query.where(id_column < last_id)
+    result = await db.execute(query.limit(page_size + 1))
+    results = result.scalars().all()
+    next_cursor = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_cursor = encode_cursor({'id': results[-1].id, **(filters or {})})
+    return {
+        "page_size": page_size,
+        "next_cursor": next_cursor,
+        "data": results
+    }
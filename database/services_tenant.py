@@ -1,21 +1,30 @@
 """
     Save function to use for multitenant
 """
+import io, csv, json, codecs, collections
 from fastapi import Request, HTTPException 
 from sqlalchemy.orm import (Session, mapper)
-from sqlalchemy import (text, MetaData, Table)
-from database.database import (session, engine)
+from sqlalchemy import (MetaData, Table, select, func, cast, String, Integer, insert,
+                        update, delete, values, column, any_, bindparam)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import (session, engine, tenant_session, async_session,
+                               async_tenant_session)
 from database.models_admin import Countries
-from database.models_countries import (format_schema, Brand, Toyota, Chevrolet, Ford)
+from database.models_countries import (format_schema, Brand, Toyota, Chevrolet, Ford,
+                                       coerce_value, parse_bool, get_dropped_columns)
+from database.cache import (get_table, get_schema_version, get_cached_brand, cache_brand,
+                            get_cached_tenant, cache_tenant, MISSING)
 async def get_schema_name(request: Request, db: Session):
     """
         Get the schema name from the request (sub-domain or url)
     """
     host = request.headers.get("host") 
     country_alias = host.split(".")[0] # Assuming tenant is the sub-domain return tenant
-    country = db.query(Countries).filter(Countries.alias.ilike(country_alias)).first()
+    schema_name = await resolve_schema_name(country_alias, db)
 
-    if country is None:
+    if schema_name is None:
         # Try to get the country by url path
         path = request.url.path
         path_segments = path.split('/')
@@ -23,14 +32,72 @@ async def get_schema_name(request: Request, db: Session):
             if segment == 'country':
                 try:
                     country_alias = path_segments[i+1]
-                    country = db.query(Countries).filter(Countries.alias.ilike(country_alias)).first()
-                    if country is None:
+                    schema_name = await resolve_schema_name(country_alias, db)
+                    if schema_name is None:
                         raise Exception("not found")
-                    return format_schema(country)
+                    return schema_name
                 except:
                     raise HTTPException(404,"Country not found")
+        raise HTTPException(404,"Country not found")
+
+    return schema_name
+
+async def resolve_schema_name(country_alias:str, db: Session):
+    """
+        Return the schema name of the alias (None if the country does not exist),
+        the database is only used when the alias is not cached
+    """
+    schema_name = get_cached_tenant(country_alias)
+    if schema_name is not MISSING:
+        return schema_name
+    country = db.query(Countries).filter(Countries.alias.ilike(country_alias)).first()
+    schema_name = format_schema(country) if country is not None else None
+    cache_tenant(country_alias, schema_name)
+    return schema_name
+
+async def resolve_schema_name_async(country_alias:str, db: AsyncSession):
+    """
+        Async version of resolve_schema_name
+    """
+    schema_name = get_cached_tenant(country_alias)
+    if schema_name is not MISSING:
+        return schema_name
+    result = await db.execute(select(Countries).where(Countries.alias.ilike(country_alias)))
+    country = result.scalars().first()
+    schema_name = format_schema(country) if country is not None else None
+    cache_tenant(country_alias, schema_name)
+    return schema_name
+
+def get_path_alias(request: Request):
+    """
+        Return the country alias of the url path (/country/{alias}/...)
+    """
+    path_segments = request.url.path.split('/')
+    for i, segment in enumerate(path_segments):
+        if segment == 'country' and i + 1 < len(path_segments):
+            return path_segments[i+1]
+    return None
+
+def preload_tenants():
+    """
+        Load the schema name of every country in the tenant cache
+    """
+    db = session()
+    try:
+        for country in db.query(Countries).all():
+            cache_tenant(country.alias, format_schema(country))
+    finally:
+        db.close()
 
-    return format_schema(country)
+def get_tenant_schemas() -> list:
+    """
+        Return the schema name of every country
+    """
+    db = session()
+    try:
+        return [format_schema(country) for country in db.query(Countries).all()]
+    finally:
+        db.close()
 
 async def get_db_schemas(request: Request):
     """
@@ -38,36 +105,165 @@ async def get_db_schemas(request: Request):
     """
     db = session()
     try:
+        # The session only connects to the db when the alias is not cached
         schema_name = await get_schema_name(request, db)
-        db.execute(text(f'SET search_path TO administration, {schema_name}'))
+    finally:
+        db.close()
+    db = tenant_session(schema_name)
+    try:
         yield db
     finally:
         db.close()
 
 
+async def get_async_db_schemas(request: Request):
+    """
+        return the async db object pointer to a schema
+    """
+    async with async_session() as db:
+        # The session only connects to the db when the alias is not cached
+        host = request.headers.get("host")
+        schema_name = await resolve_schema_name_async(host.split(".")[0], db)
+        if schema_name is None:
+            country_alias = get_path_alias(request)
+            if country_alias is not None:
+                schema_name = await resolve_schema_name_async(country_alias, db)
+        if schema_name is None:
+            raise HTTPException(404,"Country not found")
+    async with async_tenant_session(schema_name) as db:
+        yield db
+
+
 async def build_table(country_alias:str, db: Session, brand_id: int):
     """
-        Return 
+        Return the reflected table of the brand, the table is cached until a ddl
+        change the schema
     """
     try:
-        metadata = await get_metadata_schema(country_alias, db)
-        tables = metadata.tables
-        schema_name = metadata.schema
-        table = await get_table_from_brand(brand_id, schema_name, tables, db)
-        return table
+        schema_name = db.info.get('schema_name')
+        if schema_name is None:
+            schema_name = await get_schema_from_alias(country_alias, db)
+        table_name = await get_brand_table_name(brand_id, schema_name, db)
+        return get_table(schema_name, table_name, engine,
+                         lambda: get_dropped_columns(schema_name, table_name))
     except Exception as e:
         raise HTTPException(422, str(e))
 
+def filter_element_query(query, table:Table, filter:str = None, value:str = None):
+    """
+        Add the filter of the elements list to a select of the brand table
+    """
+    if filter is not None:
+        if value is None:
+            raise HTTPException(422, 'value must not be null')
+        if not hasattr(table.c, filter):
+            raise HTTPException(422, f'{filter} field does not exists')
+        query = query.where(func.lower(cast(getattr(table.c, filter), String)).contains(value.lower()))
+    return query
+
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+}
+
+def where_element_query(query, table:Table, where:list = None):
+    """
+        Add typed filters to a select of the brand table, each filter is
+        column:operator:value and all of them must match. The values are converted
+        to the type of the column so the predicates can use an index.
+        Operators: eq, ne, gt, gte, lt, lte, in (a,b,c), range (low,high), prefix,
+        is_null (true or false) and contains (the filter/value of the list)
+    """
+    for expression in where or []:
+        parts = expression.split(':', 2)
+        if len(parts) < 2:
+            raise HTTPException(422, f'{expression} must be column:operator:value')
+        name, operator = parts[0], parts[1]
+        value = parts[2] if len(parts) == 3 else None
+        if name not in table.c:
+            raise HTTPException(422, f'{name} field does not exists')
+        column = table.c[name]
+        if value is None and operator != 'is_null':
+            raise HTTPException(422, f'{expression} value must not be null')
+        try:
+            if operator in FILTER_OPERATORS:
+                query = query.where(FILTER_OPERATORS[operator](column, coerce_value(column, value)))
+            elif operator == 'in':
+                query = query.where(column.in_([coerce_value(column, val) for val in value.split(',')]))
+            elif operator == 'range':
+                low, high = value.split(',', 1)
+                if low:
+                    query = query.where(column >= coerce_value(column, low))
+                if high:
+                    query = query.where(column <= coerce_value(column, high))
+            elif operator == 'prefix':
+                if not isinstance(coerce_value(column, value), str):
+                    raise HTTPException(422, 'prefix is only valid for text fields')
+                query = query.where(column.startswith(value, autoescape=True))
+            elif operator == 'is_null':
+                if value is None or parse_bool(value):
+                    query = query.where(column.is_(None))
+                else:
+                    query = query.where(column.is_not(None))
+            elif operator == 'contains':
+                query = filter_element_query(query, table, name, value)
+            else:
+                raise HTTPException(422, f'{operator} is not a valid operator')
+        except ValueError as e:
+            raise HTTPException(422, f'invalid value for {name}: {str(e)}')
+    return query
+
+def get_projection_fields(table:Table, fields:str = None):
+    """
+        Return the columns of a comma separated list of fields, the id is always
+        included. None when every column is selected
+    """
+    if fields is None or not fields.strip():
+        return None
+    names = ['id']
+    for name in fields.split(','):
+        name = name.strip()
+        if not name or name in names:
+            continue
+        if name not in table.c:
+            raise HTTPException(422, f'{name} field does not exists')
+        names.append(name)
+    return tuple(names)
+
+async def get_schema_from_alias(country_alias:str, db: Session):
+    """
+        Return the schema name by the country alias
+    """
+    schema_name = await resolve_schema_name(country_alias, db)
+    if schema_name is None:
+        raise HTTPException(404, "not found schema")
+    return schema_name
+
+async def get_brand_table_name(brand_id:int, schema_name:str, db: Session):
+    """
+        Return the table name of the brand
+    """
+    name = get_cached_brand(schema_name, brand_id)
+    if name is not None:
+        return name
+    version = get_schema_version(schema_name)
+    brand = db.query(Brand).filter(Brand.id == brand_id).first()
+    if brand is None:
+        raise HTTPException(404,"Not found brand")
+    cache_brand(schema_name, brand_id, brand.name, version)
+    return brand.name
+
 
 async def get_metadata_schema(country_alias:str, db: Session):
     """
         Reflect all the tables inside a specific schema
     """
-    country = db.query(Countries).filter(Countries.alias.ilike(country_alias)).first()
-    if country is None:
-        raise HTTPException(404, "not found schema")
     # get the schema name
-    schema_name = format_schema(country)
+    schema_name = await get_schema_from_alias(country_alias, db)
     metadata = MetaData(schema=schema_name)
     metadata.reflect(bind=engine)
     """
@@ -96,3 +292,168 @@ async def mapper_table(brand: Brand, table:Table):
     models = {'toyota': Toyota, 'chevrolet': Chevrolet, 'ford': Ford}
     mapper(models[name],table)
     return models[name]
+
+async def iter_upload_lines(request: Request):
+    """
+        Yield the lines of the request body (with the line break) while it is
+        uploaded, a character split between two chunks is decoded once complete
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        lines = buffer.split('\n')
+        buffer = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    buffer += decoder.decode(b'', final=True)
+    if buffer:
+        yield buffer
+
+class PendingLines:
+    """
+        Lines read by a csv.reader, they are added while the upload arrives so a
+        single reader parses the whole body
+    """
+    def __init__(self):
+        self.lines = collections.deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+async def iter_upload_rows(request: Request, format:str = 'ndjson'):
+    """
+        Yield (line number, row, error) of a ndjson or csv upload, the first line
+        of the csv is the header and the empty values are null. A csv row with a
+        quoted line break is reported with the number of its first line
+    """
+    header = None
+    line_number = 0
+    pending = PendingLines()
+    reader = csv.reader(pending)
+    row_line, quotes = None, 0
+    async for line in iter_upload_lines(request):
+        line_number += 1
+        if format == 'csv':
+            if row_line is None:
+                if not line.strip():
+                    continue
+                row_line = line_number
+            pending.lines.append(line)
+            # An odd number of quotes is a quoted field that goes on in the next line
+            quotes += line.count('"')
+            if quotes % 2:
+                continue
+            number, row_line, quotes = row_line, None, 0
+        elif not line.strip():
+            continue
+        else:
+            number = line_number
+        try:
+            if format == 'csv':
+                values = next(reader)
+                if header is None:
+                    header = values
+                    continue
+                if len(values) != len(header):
+                    raise ValueError(f"expected {len(header)} values, got {len(values)}")
+                row = {key: val if val != '' else None for key, val in zip(header, values)}
+            else:
+                row = json.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError("the row must be an object")
+            yield number, row, None
+        except (ValueError, csv.Error) as e:
+            yield number, None, str(e)
+    if row_line is not None:
+        yield row_line, None, "unterminated quoted field"
+
+def insert_element_batch(db: Session, table: Table, batch: list):
+    """
+        Insert a batch of rows [(line number, data)] in a savepoint and return
+        [(line number, id, error)]. The rows are grouped by columns, when a group
+        fails it is inserted row by row to report the failing rows
+    """
+    results = []
+    groups = {}
+    for line, data in batch:
+        groups.setdefault(tuple(sorted(data)), []).append((line, data))
+    for rows in groups.values():
+        try:
+            with db.begin_nested():
+                statement = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+                ids = db.execute(statement, [data for _, data in rows]).scalars().all()
+            results += [(line, new_id, None) for (line, _), new_id in zip(rows, ids)]
+        except SQLAlchemyError:
+            for line, data in rows:
+                try:
+                    with db.begin_nested():
+                        statement = insert(table).values(**data).returning(table.c.id)
+                        new_id = db.execute(statement).scalar_one()
+                    results.append((line, new_id, None))
+                except SQLAlchemyError as e:
+                    results.append((line, None, str(getattr(e, 'orig', None) or e)))
+    return results
+
+def iter_export(query, response_model, format:str = 'ndjson', fetch_size:int = 1000):
+    """
+        Yield the rows of the query encoded as ndjson or csv. The rows are read
+        from a server side cursor fetch_size at a time with its own connection, so
+        the memory does not depend on the size of the table
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=fetch_size).execute(query)
+        columns = list(response_model.model_fields)
+        if format == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            yield buffer.getvalue()
+        for partition in result.partitions():
+            if format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in partition:
+                    values = response_model.model_validate(row).model_dump(mode='json')
+                    writer.writerow([values[column] for column in columns])
+                yield buffer.getvalue()
+            else:
+                yield ''.join(response_model.model_validate(row).model_dump_json() + '\n'
+                              for row in partition)
+
+def update_element_batch(db: Session, table: Table, items: dict):
+    """
+        Update many elements {id: data} with one UPDATE ... FROM (VALUES ...)
+        RETURNING by group of columns, return the updated rows by id
+    """
+    updated = {}
+    groups = {}
+    for element_id, data in items.items():
+        groups.setdefault(tuple(sorted(data)), []).append((element_id, data))
+    for columns, rows in groups.items():
+        if not columns:
+            continue
+        batch = values(column('id', Integer),
+                       *[column(name, table.c[name].type) for name in columns],
+                       name='batch')\
+            .data([(element_id, *[data[name] for name in columns]) for element_id, data in rows])
+        statement = update(table).where(table.c.id == batch.c.id)\
+            .values({name: cast(batch.c[name], table.c[name].type) for name in columns})\
+            .returning(table)
+        for row in db.execute(statement):
+            updated[row.id] = row
+    return updated
+
+def delete_element_batch(db: Session, table: Table, ids: list):
+    """
+        Delete many elements with DELETE ... WHERE id = ANY(...), return the deleted ids
+    """
+    statement = delete(table)\
+        .where(table.c.id == any_(bindparam('ids', ids, type_=ARRAY(Integer))))\
+        .returning(table.c.id)
+    return set(db.execute(statement).scalars().all())
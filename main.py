@@ -12,6 +12,12 @@ from pydantic import BaseModel
 from database.database import (Base, engine)
 from routers.router_admin import router as router_admin
 from routers.router_tenant import router as router_tenant
+from database.notify import (start_listener, stop_listener)
+from database.maintenance import (start_maintenance, stop_maintenance)
+from database.services_tenant import preload_tenants
+from database.security import shutdown_executor
+from database.jobs import (resume_jobs, shutdown_jobs)
+from database.models_countries import create_extensions
 
 app = FastAPI()
 SECRET_SESSION=os.getenv('SECRET_SESSION')
@@ -25,6 +31,43 @@ class SchemaRequest(BaseModel):
 
 # Base.metadata.create_all(bind=engine)
 
+def is_listener_enabled():
+    """
+        Check if this worker must listen the ddl changes of the other workers
+    """
+    return os.getenv('TENANT_DDL_LISTENER', 'true') in [1, '1', 'true', 'True']
+
+def is_maintenance_enabled():
+    """
+        Check if this worker must drop the hidden columns in background
+    """
+    return os.getenv('MAINTENANCE_WORKER', 'true') in [1, '1', 'true', 'True']
+
+@app.on_event('startup')
+async def startup():
+    """
+        Create the extensions, load the countries in the tenant cache, resume the
+        pending jobs, listen the ddl changes made by other workers to invalidate
+        it and start the maintenance
+    """
+    create_extensions()
+    preload_tenants()
+    resume_jobs()
+    if is_listener_enabled():
+        start_listener()
+    if is_maintenance_enabled():
+        start_maintenance()
+
+@app.on_event('shutdown')
+async def shutdown():
+    """
+        Stop the background workers
+    """
+    stop_listener()
+    stop_maintenance()
+    shutdown_executor()
+    shutdown_jobs()
+
 @app.get('/')
 async def initial():
     """
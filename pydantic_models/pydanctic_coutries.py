@@ -1,17 +1,19 @@
 """
     This file will contains the logic for the schema (tenant) pydantic models
 """
-from pydantic import (BaseModel, Field, PositiveInt, field_validator, create_model)
+import os
+from pydantic import (BaseModel, Field, PositiveInt, field_validator, create_model, ConfigDict)
 from sqlalchemy.orm import Session
 from sqlalchemy import Table
 from datetime import datetime
-from typing import (Optional, List, Type)
+from typing import (Optional, List, Type, NamedTuple, Literal)
 from fastapi import (Depends, HTTPException)
 from database.database import session
 from database.models_admin  import Types
 from pydantic_models.pydantic_admin import TypeResponse
 from database.models_countries import (Brand, clean_string)
 from database.services_tenant import get_db_schemas
+from database.cache import (TTLCache, MISSING)
 # from typing import Generator
 class BrandBase(BaseModel):
     """
@@ -48,6 +50,8 @@ class ExtraBase(BaseModel):
     display_name:str = Field(min_length=2)
     type_id: PositiveInt
     brand_id: PositiveInt
+    indexed: Optional[bool] = False
+    index_type: Optional[Literal['btree', 'trigram', 'hash']] = None
     # countries: Optional[list] = None
 
     # @field_validator('brand_id')
@@ -94,6 +98,7 @@ class ExtraResponse(ExtraBase):
         Pydanctic to response for a extra model
     """
     id: int
+    index_status: Optional[str] = None
     created_at: datetime
     updated_at: datetime
     class Config:
@@ -105,6 +110,7 @@ class ExtraResponseBrandType(ExtraBase):
         Pydanctic model that also contains details data for brand and type models
     """
     id: int
+    index_status: Optional[str] = None
     created_at: datetime
     updated_at: datetime
     type_model: Optional[TypeResponse] = None
@@ -120,6 +126,8 @@ class ExtraEdit(BaseModel):
     name: str
     display_name: str
     fixable: Optional[bool] = True
+    indexed: Optional[bool] = None
+    index_type: Optional[Literal['btree', 'trigram', 'hash']] = None
     class Config:
         """Configuration for the pydantic model"""
         from_attributes = True
@@ -132,6 +140,44 @@ class ExtraEdit(BaseModel):
         """
         return clean_string(value)
 
+class ExtraBatchEdit(ExtraEdit):
+    """
+        Pydantic model to edit an extra in a batch
+    """
+    id: PositiveInt
+
+class ExtrasBatch(BaseModel):
+    """
+        Extras to create and edit in the same transaction
+    """
+    create: List[ExtrasCreate] = []
+    edit: List[ExtraBatchEdit] = []
+
+class ExtraTypeChangeCreate(BaseModel):
+    """
+        Pydantic model to change the type of an extra
+    """
+    type_id: PositiveInt
+    batch_size: int = Field(1000, gt=0, le=100000)
+
+class ExtraTypeChangeResponse(BaseModel):
+    """
+        Progress of the type change of an extra
+    """
+    id: int
+    extra_id: int
+    type_id: int
+    status: str
+    batch_size: int
+    last_id: int
+    processed: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+    class Config:
+        """Configuration for the pydantic model"""
+        from_attributes = True
+
 # Dependency to validate brand_id
 def validate_extra_fk(
     extra: ExtrasCreate,
@@ -148,13 +194,53 @@ def validate_extra_fk(
     return extra
 
 
+class ElementBatchItem(BaseModel):
+    """
+        Data to update an element in a batch
+    """
+    id: PositiveInt
+    data: dict
+
+class ElementBatchUpdate(BaseModel):
+    """
+        Batch update of elements, a list of items (id and data) or a filter with
+        the data for every element that match it
+    """
+    items: Optional[List[ElementBatchItem]] = None
+    filter: Optional[str] = None
+    value: Optional[str] = None
+    data: Optional[dict] = None
+
+class ElementBatchDelete(BaseModel):
+    """
+        Batch delete of elements by ids or filter
+    """
+    ids: Optional[List[PositiveInt]] = None
+    filter: Optional[str] = None
+    value: Optional[str] = None
+
+class ElementModels(NamedTuple):
+    """
+        Pydantic models generated for a brand table
+    """
+    create: Type[BaseModel]
+    update: Type[BaseModel]
+    response: Type[BaseModel]
+
+# (schema, table, ddl version) -> ElementModels
+ELEMENT_MODELS_CACHE_SIZE = int(os.getenv('ELEMENT_MODELS_CACHE_SIZE', 512))
+_element_models = TTLCache(ELEMENT_MODELS_CACHE_SIZE)
+# Columns filled by the db, they are not sent in create or update
+READ_ONLY_COLUMNS = ('id', 'created_at', 'updated_at')
+
 class ResponsePaginated(BaseModel):
     """
-        Base pydanctic model for pagination
+        Base pydanctic model for pagination, the cursor mode only returns next_cursor
     """
-    page: int
-    total_pages: int
-    total: int
+    page: Optional[int] = None
+    total_pages: Optional[int] = None
+    total: Optional[int] = None
+    next_cursor: Optional[str] = None
 
 class ExtraResponsePaginated(ResponsePaginated):
     """
@@ -165,26 +251,56 @@ class ExtraResponsePaginated(ResponsePaginated):
         """config class"""
         from_attributes = True
 
-def generate_pydantic_model(table: Table) -> Type[BaseModel]:
+def generate_pydantic_model(table: Table, variant:str = 'response',
+                            columns: list = None) -> Type[BaseModel]:
+    """
+        Create a pydantic model from the columns of the table (or only the given
+        columns). create does not have the id and the columns with default are
+        optional, update has every column optional except the read only ones
+    """
     fields = {}
-    for column in table.columns: 
+    for column in (columns if columns is not None else table.columns): 
         column_type = column.type.python_type
-        if column.nullable:
+        if variant != 'response' and column.name in READ_ONLY_COLUMNS:
+            continue
+        if column.nullable or variant == 'update' or \
+                (variant == 'create' and column.server_default is not None):
             fields[column.name] = (Optional[column_type], None)
         else: 
             fields[column.name] = (column_type, ...)
-    # Config
-    class Config:
-        orm_mode = True
-        extra = 'ignore'
-    
+    suffix = '' if variant == 'response' else variant.capitalize()
     model = create_model(
-        table.name.capitalize(),  # Model name
+        f"{table.name.capitalize()}{suffix}",  # Model name
         **fields,
         # __base__=BaseModel,
-        __config__=Config
+        __config__=ConfigDict(from_attributes=True, extra='ignore')
     )
     return model
+
+def get_element_models(table: Table) -> ElementModels:
+    """
+        Return the create, update and response models of the table, they are only
+        generated again when the ddl version of the schema changes
+    """
+    key = (table.schema, table.name, table.info.get('schema_version'))
+    models = _element_models.get(key)
+    if models is MISSING:
+        models = ElementModels(create=generate_pydantic_model(table, 'create'),
+                               update=generate_pydantic_model(table, 'update'),
+                               response=generate_pydantic_model(table, 'response'))
+        _element_models.set(key, models)
+    return models
+
+def get_projection_model(table: Table, fields: tuple) -> Type[BaseModel]:
+    """
+        Return the response model with only the given fields of the table
+    """
+    key = (table.schema, table.name, table.info.get('schema_version'), fields)
+    model = _element_models.get(key)
+    if model is MISSING:
+        model = generate_pydantic_model(table, 'response', [table.c[name] for name in fields])
+        _element_models.set(key, model)
+    return model
 """
 from pydantic import BaseModel, create_model
 from typing import Type
@@ -149,4 +149,24 @@ class TypeResponse(TypesBase):
     updated_at: datetime
     class Config:
         """Required class"""
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class JobResponse(BaseModel):
+    """
+        Pydantic model to response the status of a job
+    """
+    id: int
+    kind: str
+    status: str
+    country_id: Optional[int] = None
+    country_alias: Optional[str] = None
+    schema_name: str
+    error: Optional[str] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    created_at: datetime
+    updated_at: datetime
+    class Config:
+        """Required class"""
+        from_attributes = True
@@ -3,21 +3,25 @@
 """
 import os
 from typing import List
-from passlib.hash import bcrypt
 from sqlalchemy.orm import Session
 from starlette.responses import RedirectResponse
 from authlib.integrations.starlette_client import (OAuth,OAuthError)
-from sqlalchemy import desc
+from sqlalchemy import (desc, select)
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi import (APIRouter, Depends, HTTPException, Request,status)
 from fastapi.responses import JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic_models.pydantic_admin import (UserCreate, UserResponse, UserEdit,
                                             UserBase, RolesResponse, RolesCreate,
-                                            CountryCreate, CountryResponse,
-                                            TypesCreate, TypeResponse, TypesEdit)
-from database.models_admin import (Users, Roles, Countries, Types)
-from database.models_countries import (create_schema, delete_schema, format_schema)
-from database.database import (get_db)
+                                            CountryCreate,
+                                            TypesCreate, TypeResponse, TypesEdit, JobResponse)
+from database.models_admin import (Users, Roles, Countries, Types, Jobs)
+from database.models_countries import format_schema
+from database.jobs import (reserve_job_slot, release_job_slot, submit_job)
+from database.cache import (invalidate_tenant, invalidate_principal)
+from database.notify import (publish_tenant, publish_principal)
+from database.database import (get_db, get_async_db)
+from database.security import hash_password
 from database.services import (save_instance, get_instance, filter_db, get_user_authenticate,
                                get_current_user, get_admin_user,get_schema)
 
@@ -58,7 +62,7 @@ async def create_user(request_user: UserCreate, request: Request,db: Session = D
         if not user is None:
             raise Exception("Email already registered, try with other email")
         password = data_user.pop('password', None)
-        password_hash = bcrypt.hash(password)
+        password_hash = await hash_password(password)
         data_user['password_hash'] = password_hash
         # Add role guest to the user
         if not is_admin:
@@ -78,6 +82,8 @@ async def create_user(request_user: UserCreate, request: Request,db: Session = D
         request.session['user'] = user.model_dump()
         # response.set_cookie('user_id', instance.id, max_age=600)
         return user
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(422,f"error {str(e)}") from e
 
@@ -149,9 +155,11 @@ async def edit_user(user_data: UserEdit, user_id: int, user_admin: UserResponse
         if hasattr(user, field):
             if not field in black_list and val is not None:
                 setattr(user, field, val)
+    publish_principal(db, user_id)
     # Save to the db
     db.commit()
     db.refresh(user)
+    invalidate_principal(user_id)
     return user
 
 @router.delete('/user/{user_id}', status_code=204)
@@ -163,19 +171,21 @@ async def delete_user(user_id:int, user_admin: UserResponse = Depends(get_admin_
     if user is None:
         raise HTTPException(404, "User not found")
     db.delete(user)
+    publish_principal(db, user_id)
     db.commit()
+    invalidate_principal(user_id)
     return
 
 """
     Roles api's
 """
 @router.get('/rol', response_model=List[RolesResponse])
-async def get_list_roles(db: Session = Depends(get_db)):
+async def get_list_roles(db: AsyncSession = Depends(get_async_db)):
     """
         List of roles
     """
-    roles = db.query(Roles).order_by(desc(Roles.id)).all()
-    return roles
+    result = await db.execute(select(Roles).order_by(desc(Roles.id)))
+    return result.scalars().all()
 
 @router.post('/rol', response_model=RolesResponse, status_code=201)
 async def create_rol(rol_data: RolesCreate, db:Session=Depends(get_db)):
@@ -195,39 +205,79 @@ async def delete_rol(rol_id:int, db:Session=Depends(get_db)):
     if rol is None:
         raise HTTPException(404, "rol not found")
     db.delete(rol)
+    # The role could be cached in the principal of any user
+    publish_principal(db)
     db.commit()
+    invalidate_principal()
     return
 
 
-@router.post('/country', response_model=CountryResponse, status_code=201)
+@router.post('/country', response_model=JobResponse, status_code=202)
 async def create_country(country_data: CountryCreate,
                          user: UserResponse = Depends(get_admin_user),
                          db:Session = Depends(get_db)):
+    """
+        Save the country and create its schema in background, the job shows the
+        progress (GET /jobs/{job_id})
+    """
     # check if the country already exists
     country = db.query(Countries).filter(Countries.name.ilike(country_data.name)).first()
     if country is not None:
         raise HTTPException(422, "Country already exists")
-    country = await save_instance(Countries(**country_data.model_dump()), db)
-    """
-        After save it, create the schemas with the initial country name or alias
-    """
-    schema_name = format_schema(country)
-    create_schema(schema_name, db)
-    #await create_db(engine)
-    return country
+    reserve_job_slot()
+    try:
+        country = Countries(**country_data.model_dump())
+        db.add(country)
+        db.flush()
+        job = Jobs(kind='create_country', country_id=country.id, country_alias=country.alias,
+                   schema_name=format_schema(country))
+        job = await save_instance(job, db)
+    except Exception:
+        release_job_slot()
+        raise
+    # The alias could be cached as a missing country
+    invalidate_tenant(country.alias)
+    submit_job(job.id)
+    return job
 
-@router.delete('/country/{country_id}', status_code=204)
+@router.delete('/country/{country_id}', response_model=JobResponse, status_code=202)
 async def delete_country(country_id:int,
                          user: UserResponse = Depends(get_admin_user),
                          db:Session = Depends(get_db)):
+    """
+        Delete the country at once and drop its schema in background
+    """
     country = await get_instance(Countries, db, country_id)
     if country is None:
         raise HTTPException(404, 'Country not found')
-    schema_name = format_schema(country)
-    db.delete(country)
-    db.commit()
-    delete_schema(schema_name)
-    return
+    reserve_job_slot()
+    try:
+        job = Jobs(kind='delete_country', country_id=country.id, country_alias=country.alias,
+                   schema_name=format_schema(country))
+        db.add(job)
+        db.delete(country)
+        publish_tenant(db, country.alias)
+        db.commit()
+        db.refresh(job)
+    except Exception:
+        db.rollback()
+        release_job_slot()
+        raise
+    invalidate_tenant(job.country_alias)
+    submit_job(job.id)
+    return job
+
+@router.get('/jobs/{job_id}', response_model=JobResponse)
+async def get_job(job_id:int,
+                  user: UserResponse = Depends(get_admin_user),
+                  db:Session = Depends(get_db)):
+    """
+        Show the status of a job (pending, running, done or failed)
+    """
+    job = await get_instance(Jobs, db, job_id)
+    if job is None:
+        raise HTTPException(404, 'Job not found')
+    return job
 
 @router.post('/types', status_code=201, response_model=TypeResponse)
 async def create_types(types_data: TypesCreate, db: Session = Depends(get_db)):
@@ -238,11 +288,12 @@ async def create_types(types_data: TypesCreate, db: Session = Depends(get_db)):
     return await save_instance(type_model, db)
 
 @router.get('/types', response_model=List[TypeResponse])
-async def get_types(db: Session = Depends(get_db)):
+async def get_types(db: AsyncSession = Depends(get_async_db)):
     """
         Endpoint to see a list of types
     """
-    types_model = db.query(Types).order_by(Types.id.desc()).all()
+    result = await db.execute(select(Types).order_by(Types.id.desc()))
+    types_model = result.scalars().all()
     if not types_model:
         raise HTTPException(404, 'types not found')
     return types_model
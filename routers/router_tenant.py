@@ -2,22 +2,40 @@
     File to contains the logic to handle request made to table that are in different
     schemas (tenant)
 """
-import asyncio, math
-from typing import Optional
+import os, math
+from typing import (Optional, Literal, List)
 from sqlalchemy.orm import (Session, joinedload)
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import (or_, cast, String, insert, select, desc, func, update, delete)
-from fastapi import (APIRouter, Depends, HTTPException, Query)
-from database.models_countries import (Extras, Brand, add_column, modify_column,
-                                       drop_column)
+from fastapi import (APIRouter, Depends, HTTPException, Query, Request, BackgroundTasks)
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+from database.models_countries import (Extras, Brand, ExtraTypeChange, ExtraTombstone,
+                                       add_column, add_columns, modify_column, drop_column,
+                                       build_extra_index, change_column_type, coerce_value,
+                                       clean_string, has_extension, TEXT_TYPES,
+                                       TYPE_CHANGE_ACTIVE)
 from database.models_admin import Types
-from database.database import (get_db)
 from database.services import (save_instance, get_instance, filter_db,get_current_user,
-                            get_admin_user,paginated_query)
-from database.services_tenant import (get_db_schemas,build_table)
+                            get_admin_user, count_rows, encode_cursor,
+                            decode_cursor)
+from database.services_tenant import (get_db_schemas, get_async_db_schemas, build_table,
+                                      filter_element_query, iter_upload_rows,
+                                      insert_element_batch, iter_export,
+                                      update_element_batch, delete_element_batch,
+                                      get_projection_fields, where_element_query)
+from database import services_async as async_services
 from pydantic_models.pydantic_admin import UserResponse
 from pydantic_models.pydanctic_coutries import (ExtraResponse, ExtrasCreate, validate_extra_fk,
                                                 ExtraResponsePaginated, ExtraResponseBrandType,
-                                                ExtraEdit, generate_pydantic_model)
+                                                ExtraEdit, get_element_models,
+                                                ElementBatchUpdate, ElementBatchDelete,
+                                                get_projection_model, ExtraTypeChangeCreate,
+                                                ExtraTypeChangeResponse, ExtrasBatch)
+# Label of the window count in the page query of list_element
+TOTAL_COLUMN = '__total'
+# Rows fetched at a time from the server side cursor of the export
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', 1000))
 router = APIRouter(
     prefix='/country/{country_alias}',
     tags=['tenant']
@@ -25,43 +43,137 @@ router = APIRouter(
 
 @router.post('/extra', status_code=201, response_model=ExtraResponse)
 async def create_extra(country_alias:str, data: ExtrasCreate,
+                background_tasks: BackgroundTasks,
                 user: UserResponse = Depends(get_admin_user),
                 # schema_name:str = Depends(get_schema_name),
                 db: Session = Depends(get_db_schemas)):
     """
-        Create an extra and add the column to the table
+        Create an extra and add the column to the table, when it is indexed the
+        index is built in background (see index_status)
     """
     validate_extra_fk(data, db)
     # Dump the model and get the type and brand
     data = data.model_dump()
     type_id = data['type_id']
     brand_id = data['brand_id']
-    type_db, brand_db = await asyncio.gather(
-        get_instance(Types, db, type_id),
-        get_instance(Brand, db, brand_id)
-    )
+    # A Session runs one query at a time, gather would not run them concurrently
+    type_db = await get_instance(Types, db, type_id)
+    brand_db = await get_instance(Brand, db, brand_id)
+    if data['indexed']:
+        data['index_type'] = data['index_type'] or 'btree'
+        data['index_status'] = 'pending'
+        validate_index_type(data['index_type'], type_db.name)
+    check_dropped_columns(db, [(brand_db.name, clean_string(data['name']))])
     # Save the model in the db and add new column
     try:
         extra_db = Extras(**data, brand = brand_db, type_model = type_db)
         extra_db = await save_instance(extra_db, db)
         await add_column(extra_db, db)
-        return extra_db
     except Exception as e:
         raise HTTPException(422, str(e))
+    if extra_db.indexed:
+        background_tasks.add_task(build_extra_index, db.info['schema_name'], extra_db.id)
+    return extra_db
+
+@router.post('/extra/batch', status_code=201, response_model=List[ExtraResponse])
+async def batch_extras(country_alias:str, data: ExtrasBatch,
+                       background_tasks: BackgroundTasks,
+                       user: UserResponse = Depends(get_admin_user),
+                       db: Session = Depends(get_db_schemas)):
+    """
+        Create and edit many extras in one transaction, the new columns of each
+        brand are added with a single ALTER TABLE. Nothing is saved if one fails
+    """
+    type_ids = {extra.type_id for extra in data.create}
+    brand_ids = {extra.brand_id for extra in data.create}
+    types = {type_db.id: type_db for type_db in db.query(Types).filter(Types.id.in_(type_ids))}
+    brands = {brand.id: brand for brand in db.query(Brand).filter(Brand.id.in_(brand_ids))}
+    if len(brands) != len(brand_ids):
+        raise HTTPException(404, "Brand does not exist")
+    if len(types) != len(type_ids):
+        raise HTTPException(404, "Type does not exist.")
+    names = [(extra.brand_id, extra.name) for extra in data.create]
+    if len(set(names)) != len(names):
+        raise HTTPException(422, 'the extras of a brand must have different names')
+    query = db.query(Extras).options(joinedload(Extras.brand), joinedload(Extras.type_model))
+    edit_ids = [extra.id for extra in data.edit]
+    edited = {extra.id: extra for extra in query.filter(Extras.id.in_(edit_ids))}
+    if len(edited) != len(set(edit_ids)):
+        raise HTTPException(404, 'extra does not found')
+    if db.query(ExtraTypeChange).filter(ExtraTypeChange.extra_id.in_(edit_ids),
+                                        ExtraTypeChange.status.in_(TYPE_CHANGE_ACTIVE)).first():
+        raise HTTPException(409, 'the type of the extra is changing')
+    try:
+        created = []
+        for extra in data.create:
+            extra = extra.model_dump()
+            if extra['indexed']:
+                extra['index_type'] = extra['index_type'] or 'btree'
+                extra['index_status'] = 'pending'
+                validate_index_type(extra['index_type'], types[extra['type_id']].name)
+            created.append(Extras(**extra, brand=brands[extra['brand_id']],
+                                  type_model=types[extra['type_id']]))
+        renamed, rebuild_ids = [], []
+        for extra in data.edit:
+            extra_db = edited[extra.id]
+            previous_name = extra_db.name
+            if apply_extra_edit(extra_db, extra):
+                rebuild_ids.append(extra_db.id)
+            renamed.append((previous_name, extra_db))
+        check_dropped_columns(db, [(extra.brand.name, clean_string(extra.name))
+                                   for extra in created + list(edited.values())])
+        db.add_all(created)
+        db.flush()
+        await add_columns(created, db, renamed)
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(422, str(e))
+    rebuild_ids += [extra.id for extra in created if extra.indexed]
+    for extra_id in rebuild_ids:
+        background_tasks.add_task(build_extra_index, db.info['schema_name'], extra_id)
+    return created + list(edited.values())
 
 @router.get('/extra', response_model=ExtraResponsePaginated)
 async def get_extras(country_alias:str, page:int = Query(1, ge=1),
                      filter: Optional[str] = None, value:Optional[str] = None,
                      search:Optional[str] = None,
+                     search_mode: Literal['contains', 'trigram'] = 'contains',
+                     pagination: Literal['page', 'cursor'] = 'page',
+                     cursor: Optional[str] = None,
                     user: UserResponse = Depends(get_current_user),
-                     db:Session = Depends(get_db_schemas)):
+                     db:AsyncSession = Depends(get_async_db_schemas)):
     """
-        Show list of extras.
+        Show list of extras. pagination=cursor returns next_cursor, the next
+        pages only need the cursor (it saves the filter and search).
+        search_mode=trigram uses the trigram indexes and sorts by similarity
     """
-    query =  db.query(Extras)
+    cursor_data = {}
+    if cursor is not None:
+        cursor_data = decode_cursor(cursor)
+        filter = cursor_data.get('filter')
+        value = cursor_data.get('value')
+        search = cursor_data.get('search')
+    query = select(Extras)
+    order_by = [Extras.id.desc()]
     # Search
-    if search is not None and len(search) > 0:
-        query = query.filter(or_(
+    if search is not None and len(search) > 0 and search_mode == 'trigram':
+        if cursor is not None or pagination == 'cursor':
+            raise HTTPException(422, 'trigram search does not support cursor pagination')
+        if not has_extension('pg_trgm'):
+            raise HTTPException(422, 'trigram search needs the pg_trgm extension')
+        conditions = [Extras.name.op('%')(search), Extras.display_name.op('%')(search),
+                      Extras.name.icontains(search), Extras.display_name.icontains(search)]
+        # The ids are exact matches instead of a cast of the column
+        if search.isdigit():
+            conditions += [Extras.brand_id == int(search), Extras.type_id == int(search)]
+        query = query.where(or_(*conditions))
+        order_by.insert(0, func.greatest(func.similarity(Extras.name, search),
+                                         func.similarity(Extras.display_name, search)).desc())
+    elif search is not None and len(search) > 0:
+        query = query.where(or_(
             Extras.name.icontains(search),
             Extras.display_name.icontains(search),
             cast(Extras.brand_id, String).icontains(search),
@@ -69,25 +181,33 @@ async def get_extras(country_alias:str, page:int = Query(1, ge=1),
         ))
     # There is a value and filter
     if filter is not None and value is not None:
-        if hasattr(Extras, filter):
-            query = query.filter(getattr(Extras, filter) == value)
-        else:
+        if filter not in Extras.__table__.c:
             raise HTTPException(422, f"{filter} not exists")
-    query = query.order_by(Extras.id.desc())
+        column = Extras.__table__.c[filter]
+        try:
+            # asyncpg does not cast the strings to the type of the column
+            query = query.where(column == coerce_value(column, value))
+        except ValueError as e:
+            raise HTTPException(422, f'invalid value for {filter}: {str(e)}')
+    query = query.order_by(*order_by)
     size = 25
+    if cursor is not None or pagination == 'cursor':
+        filters = {'filter': filter, 'value': value, 'search': search}
+        return await async_services.keyset_query(query, db, Extras.id, size,
+                                                 cursor_data.get('id'), filters)
     offset = (page - 1) * size
-    return await paginated_query(query, page, size, offset)
+    return await async_services.paginated_query(query, db, page, size, offset)
 
 
 @router.get('/extra/{extra_id}', response_model=ExtraResponseBrandType)
 async def get_extras_details(country_alias:str, extra_id: int,
                     user: UserResponse = Depends(get_current_user),
-                     db:Session = Depends(get_db_schemas)):
+                     db:AsyncSession = Depends(get_async_db_schemas)):
     """
         Show list of extras.
     """
-    query = db.query(Extras).options(joinedload(Extras.brand), joinedload(Extras.type_model))
-    extra_db = await get_instance(Extras, db, extra_id, query)
+    query = select(Extras).options(joinedload(Extras.brand), joinedload(Extras.type_model))
+    extra_db = await async_services.get_instance(Extras, db, extra_id, query)
     if not extra_db:
         raise HTTPException(404, 'extra does not found')
     return extra_db
@@ -96,30 +216,126 @@ async def get_extras_details(country_alias:str, extra_id: int,
 @router.put('/extra/{extra_id}', response_model=ExtraResponse)
 async def edit_extras(country_alias:str, extra_id: int,
                       data: ExtraEdit,
+                      background_tasks: BackgroundTasks,
                     user: UserResponse = Depends(get_current_user),
                      db:Session = Depends(get_db_schemas)):
     """
-        Show list of extras.
+        Edit the name of an extra, changing indexed or index_type rebuilds the
+        index in background
     """
     query = db.query(Extras).options(joinedload(Extras.brand), joinedload(Extras.type_model))
     extra_db = await get_instance(Extras, db, extra_id,query=query)
     if not extra_db:
         raise HTTPException(404, 'extra does not found')
+    if get_active_type_change(db, extra_id) is not None:
+        raise HTTPException(409, 'the type of the extra is changing')
     previous_name = extra_db.name
     # Edit the new extra
     try:
-        for field, val in data.model_dump().items():
-            if hasattr(extra_db, field):
-                setattr(extra_db, field, val)
+        rebuild_index = apply_extra_edit(extra_db, data)
+        check_dropped_columns(db, [(extra_db.brand.name, clean_string(extra_db.name))])
         db.flush()
         db.refresh(extra_db)
         await modify_column(previous_name, extra_db, db)
         db.commit()
-        return extra_db
+    except HTTPException:
+        db.rollback()
+        raise
     except Exception as e:
         db.rollback()
         raise HTTPException(422, str(e))
+    if rebuild_index:
+        background_tasks.add_task(build_extra_index, db.info['schema_name'], extra_db.id)
+    return extra_db
+
 
+def apply_extra_edit(extra_db:Extras, data:ExtraEdit) -> bool:
+    """
+        Set the edited fields of an extra, return True if its index must be rebuilt
+    """
+    previous_index = (extra_db.indexed, extra_db.index_type)
+    for field, val in data.model_dump(exclude_none=True).items():
+        if hasattr(extra_db, field) and field != 'id':
+            setattr(extra_db, field, val)
+    rebuild_index = (extra_db.indexed, extra_db.index_type) != previous_index
+    if extra_db.indexed:
+        extra_db.index_type = extra_db.index_type or 'btree'
+        validate_index_type(extra_db.index_type, extra_db.type_model.name)
+    if rebuild_index:
+        extra_db.index_status = 'pending' if extra_db.indexed else None
+    return rebuild_index
+
+def validate_index_type(index_type:str, type_name:str):
+    """
+        Raise 422 if the index type cannot be used for the type of an extra
+    """
+    if index_type != 'trigram':
+        return
+    if type_name not in TEXT_TYPES:
+        raise HTTPException(422, 'trigram index is only valid for text fields')
+    if not has_extension('pg_trgm'):
+        raise HTTPException(422, 'trigram indexes need the pg_trgm extension')
+
+def check_dropped_columns(db:Session, columns:list):
+    """
+        Raise 409 if a column (table name, column name) is of a deleted extra that
+        the maintenance worker has not dropped yet
+    """
+    for table_name, column_name in columns:
+        tombstone = db.query(ExtraTombstone).filter(ExtraTombstone.table_name == table_name,
+                                                    ExtraTombstone.column_name == column_name,
+                                                    ExtraTombstone.status != 'dropped').first()
+        if tombstone is not None:
+            raise HTTPException(409, f'the column {column_name} of a deleted extra is not '
+                                     'dropped yet, try again later')
+
+def get_active_type_change(db:Session, extra_id:int):
+    """
+        Return the type change of the extra that is not finished
+    """
+    return db.query(ExtraTypeChange).filter(ExtraTypeChange.extra_id == extra_id,
+                                            ExtraTypeChange.status.in_(TYPE_CHANGE_ACTIVE)).first()
+
+@router.put('/extra/{extra_id}/type', status_code=202, response_model=ExtraTypeChangeResponse)
+async def change_extra_type(country_alias:str, extra_id: int,
+                            data: ExtraTypeChangeCreate,
+                            background_tasks: BackgroundTasks,
+                            user: UserResponse = Depends(get_admin_user),
+                            db:Session = Depends(get_db_schemas)):
+    """
+        Change the type of an extra without locking the brand table, the column is
+        copied in background (see GET /extra/{extra_id}/type for the progress)
+    """
+    extra_db = await get_instance(Extras, db, extra_id)
+    if not extra_db:
+        raise HTTPException(404, 'extra does not found')
+    type_db = await get_instance(Types, db, data.type_id)
+    if type_db is None:
+        raise HTTPException(404, "Type does not exist.")
+    if type_db.id == extra_db.type_id:
+        raise HTTPException(422, f'the extra is already {type_db.name}')
+    if extra_db.indexed:
+        validate_index_type(extra_db.index_type, type_db.name)
+    if get_active_type_change(db, extra_id) is not None:
+        raise HTTPException(409, 'the type of the extra is changing')
+    change_db = ExtraTypeChange(extra_id=extra_id, type_id=type_db.id,
+                                batch_size=data.batch_size)
+    change_db = await save_instance(change_db, db)
+    background_tasks.add_task(change_column_type, db.info['schema_name'], change_db.id)
+    return change_db
+
+@router.get('/extra/{extra_id}/type', response_model=ExtraTypeChangeResponse)
+async def get_extra_type_change(country_alias:str, extra_id: int,
+                                user: UserResponse = Depends(get_current_user),
+                                db:Session = Depends(get_db_schemas)):
+    """
+        Show the progress of the last type change of an extra
+    """
+    change_db = db.query(ExtraTypeChange).filter(ExtraTypeChange.extra_id == extra_id)\
+        .order_by(desc(ExtraTypeChange.id)).first()
+    if change_db is None:
+        raise HTTPException(404, 'type change does not found')
+    return change_db
 
 @router.delete('/extra/{extra_id}', status_code=204)
 async def delete_extras(country_alias:str, extra_id: int,
@@ -132,10 +348,12 @@ async def delete_extras(country_alias:str, extra_id: int,
     extra_db = await get_instance(Extras, db, extra_id,query=query)
     if not extra_db:
         raise HTTPException(404, 'extra does not found')
+    if get_active_type_change(db, extra_id) is not None:
+        raise HTTPException(409, 'the type of the extra is changing')
     try:
-        await drop_column(extra_db, db)
+        # The column is hidden in the same transaction, the maintenance worker drops it
         db.delete(extra_db)
-        db.commit()
+        await drop_column(extra_db, db)
         return
     except Exception as e:
         raise HTTPException(422, str(e))
@@ -145,47 +363,115 @@ async def list_element(country_alias:str, brand_id:int,
                         page:int = Query(1, ge=1),
                         size:int = Query(25, ge=1),
                         filter: Optional[str] = None, value:Optional[str] = None,
+                        count: Optional[Literal['exact', 'estimate', 'none']] = None,
+                        pagination: Literal['page', 'cursor'] = 'page',
+                        cursor: Optional[str] = None,
+                        fields: Optional[str] = None,
+                        where: Optional[List[str]] = Query(None),
                         user: UserResponse = Depends(get_current_user),
                         db:Session = Depends(get_db_schemas)):
     """
-        show list of elements
+        show list of elements, count=estimate use the planner statistics for huge
+        tables and count=none skip the total (default in cursor pagination).
+        pagination=cursor returns next_cursor, the next pages only need the cursor.
+        fields is a comma separated list of the columns to return and where are
+        typed filters (column:operator:value, see where_element_query)
     """
+    cursor_data = {}
+    if cursor is not None:
+        cursor_data = decode_cursor(cursor)
+        filter = cursor_data.get('filter')
+        value = cursor_data.get('value')
+        fields = cursor_data.get('fields')
+        where = cursor_data.get('where')
     table = await build_table(country_alias, db, brand_id)
-    # brand_model = generate_pydantic_model(table)
-    # Initialize the query to select all from the brand table 
-    query = select(table).order_by(desc(table.c.id))
+    projection = get_projection_fields(table, fields)
+    if projection is None:
+        response_model = get_element_models(table).response
+        # Initialize the query to select all from the brand table 
+        query = select(table)
+    else:
+        # Only the requested columns are read and serialized
+        response_model = get_projection_model(table, projection)
+        query = select(*[table.c[name] for name in projection])
+    query = query.order_by(desc(table.c.id))
     # Add filter to table
-    if filter is not None:
-        if value is None:
-            raise HTTPException(422, 'value must not be null')
-        if not hasattr(table.c, filter):
-            raise HTTPException(422, f'{filter} field does not exists')
-        query = query.where(func.lower(cast(getattr(table.c, filter), String)).contains(value.lower()))
+    query = filter_element_query(query, table, filter, value)
+    query = where_element_query(query, table, where)
+
+    if cursor is not None or pagination == 'cursor':
+        page_query = query
+        if cursor is not None:
+            page_query = page_query.where(table.c.id < cursor_data['id'])
+        results = db.execute(page_query.limit(size + 1)).fetchall()
+        data = [response_model.model_validate(result) for result in results[:size]]
+        next_cursor = None
+        if len(results) > size:
+            next_cursor = encode_cursor({'id': data[-1].id, 'filter': filter, 'value': value,
+                                         'fields': fields, 'where': where})
+        return {
+            "total": await count_rows(query, db, count or 'none'),
+            "page_size": size,
+            "next_cursor": next_cursor,
+            "data": data
+        }
 
-    # Get the total count before applying pagination 
-    total = db.execute(query).rowcount
+    count = count or 'exact'
     offset = (page - 1) * size
     # Apply pagination 
-    query = query.offset(offset).limit(size)
-    results = db.execute(query).fetchall()
-    data = []
+    page_query = query.offset(offset).limit(size)
+    if count == 'exact':
+        # The window is computed before the limit, the total comes with the page
+        page_query = page_query.add_columns(func.count().over().label(TOTAL_COLUMN))
+    results = db.execute(page_query).fetchall()
+    if count == 'exact' and len(results) > 0:
+        total = results[0]._mapping[TOTAL_COLUMN]
+    elif count == 'exact' and page == 1:
+        total = 0
+    else:
+        total = await count_rows(query, db, count)
     if len(results) == 0 and page != 1 and total != 0:
         raise HTTPException(status_code=404, detail="Page not found")
-    # Add the result to the data
-    for result in results:
-        result_val = {column.name: value for column, value in zip(table.columns, result)}
-        data.append(result_val)
-    # return "not finished"
+    # The total column is ignored by the model
+    data = [response_model.model_validate(result) for result in results]
     
     return {
         "total": total,
         "page": page,
         "page_size": size,
-        "total_pages": math.ceil(total / size),
+        "total_pages": math.ceil(total / size) if total is not None else None,
         "data": data
     }
 
 
+@router.get('/brand/{brand_id}/element/export')
+async def export_element(country_alias:str, brand_id:int,
+                         format: Literal['ndjson', 'csv'] = 'ndjson',
+                         filter: Optional[str] = None, value:Optional[str] = None,
+                         fields: Optional[str] = None,
+                         where: Optional[List[str]] = Query(None),
+                         user: UserResponse = Depends(get_current_user),
+                         db:Session = Depends(get_db_schemas)):
+    """
+        Stream every element (with the same filters and fields of the list) as
+        ndjson or csv
+    """
+    table = await build_table(country_alias, db, brand_id)
+    projection = get_projection_fields(table, fields)
+    if projection is None:
+        response_model = get_element_models(table).response
+        query = select(table)
+    else:
+        response_model = get_projection_model(table, projection)
+        query = select(*[table.c[name] for name in projection])
+    query = query.order_by(desc(table.c.id))
+    query = filter_element_query(query, table, filter, value)
+    query = where_element_query(query, table, where)
+    media_type = 'text/csv' if format == 'csv' else 'application/x-ndjson'
+    return StreamingResponse(iter_export(query, response_model, format, EXPORT_FETCH_SIZE),
+                             media_type=media_type)
+
+
 @router.post('/brand/{brand_id}/element', status_code=201)
 async def create_element(country_alias:str, brand_id:int,
                         data: dict,
@@ -195,23 +481,172 @@ async def create_element(country_alias:str, brand_id:int,
         Save a new element in the db
     """
     table = await build_table(country_alias, db, brand_id)
-    BrandModel = generate_pydantic_model(table)
+    models = get_element_models(table)
     data['user_id'] = user.id
     try:
-        fields = list(data.keys())
-        for field in fields:
-            if not hasattr(table.columns, field):
-                data.pop(field, None)
-        brand_insert = insert(table).values(**data)
-        result = db.execute(brand_insert)
+        # Unknown fields are ignored by the model
+        data = models.create.model_validate(data).model_dump(exclude_unset=True)
+        # The new row comes back with the insert, no extra select
+        brand_insert = insert(table).values(**data).returning(*table.c)
+        brand_new = db.execute(brand_insert).fetchone()
         db.commit()
-        brand_new = db.execute(select(table).where(table.c.id == result.inserted_primary_key[0])).fetchone()
-        new_brand_dict = {column.name: value for column, value in zip(table.columns, brand_new)}
-        resp = BrandModel(**dict(new_brand_dict))
-        return resp
+        return models.response.model_validate(brand_new)
     except Exception as e:
         raise HTTPException(422, f"Error {str(e)}")
 
+@router.post('/brand/{brand_id}/element/bulk')
+async def bulk_create_element(country_alias:str, brand_id:int, request: Request,
+                              format: Optional[Literal['ndjson', 'csv']] = None,
+                              batch_size:int = Query(1000, ge=1, le=10000),
+                              all_or_nothing: bool = False,
+                              user: UserResponse = Depends(get_current_user),
+                              db:Session = Depends(get_db_schemas)):
+    """
+        Save many elements from a ndjson or csv upload (one element by line) in
+        a transaction. The rows are validated and inserted in batches while the
+        body is uploaded, the invalid rows are reported by line number
+    """
+    table = await build_table(country_alias, db, brand_id)
+    models = get_element_models(table)
+    if format is None:
+        format = 'csv' if 'csv' in request.headers.get('content-type', '') else 'ndjson'
+    ids = []
+    errors = []
+    batch = []
+    async for line, data, error in iter_upload_rows(request, format):
+        if error is None:
+            data['user_id'] = user.id
+            try:
+                data = models.create.model_validate(data).model_dump(exclude_unset=True)
+            except ValidationError as e:
+                error = format_validation_error(e)
+        if error is not None:
+            errors.append({'line': line, 'error': error})
+            continue
+        batch.append((line, data))
+        if len(batch) >= batch_size:
+            results = insert_element_batch(db, table, batch)
+            batch = []
+            ids += [new_id for _, new_id, _ in results if new_id is not None]
+            errors += [{'line': line, 'error': error} for line, _, error in results if error]
+    if batch:
+        results = insert_element_batch(db, table, batch)
+        ids += [new_id for _, new_id, _ in results if new_id is not None]
+        errors += [{'line': line, 'error': error} for line, _, error in results if error]
+    errors.sort(key=lambda error: error['line'])
+    if all_or_nothing and errors:
+        db.rollback()
+        raise HTTPException(422, {'inserted': 0, 'errors': errors})
+    db.commit()
+    return {
+        "inserted": len(ids),
+        "ids": ids,
+        "errors": errors
+    }
+
+def format_validation_error(error: ValidationError):
+    """
+        Return a short message of the validation errors of a row
+    """
+    return '; '.join(f"{'.'.join(str(loc) for loc in err['loc'])}: {err['msg']}"
+                     for err in error.errors())
+
+@router.put('/brand/{brand_id}/element/batch')
+async def batch_update_element(country_alias:str, brand_id:int, data: ElementBatchUpdate,
+                               user: UserResponse = Depends(get_current_user),
+                               db:Session = Depends(get_db_schemas)):
+    """
+        Update many elements in a transaction, by items (id and data) or by a
+        filter. Return the outcome of each id
+    """
+    table = await build_table(country_alias, db, brand_id)
+    models = get_element_models(table)
+    results = []
+    try:
+        if data.items is not None:
+            # The items are keyed by id, a repeated id would only keep the last data
+            seen, duplicates = set(), set()
+            for item in data.items:
+                if item.id in seen:
+                    duplicates.add(item.id)
+                seen.add(item.id)
+            if duplicates:
+                raise HTTPException(422, f'duplicate ids: {", ".join(map(str, sorted(duplicates)))}')
+            items = {}
+            for item in data.items:
+                try:
+                    item_data = models.update.model_validate(item.data).model_dump(exclude_none=True)
+                except ValidationError as e:
+                    results.append({'id': item.id, 'status': 'invalid',
+                                    'error': format_validation_error(e)})
+                    continue
+                if not item_data:
+                    results.append({'id': item.id, 'status': 'invalid',
+                                    'error': 'data must not be empty'})
+                    continue
+                items[item.id] = item_data
+            updated = update_element_batch(db, table, items)
+            for element_id in items:
+                results.append({'id': element_id,
+                                'status': 'updated' if element_id in updated else 'not_found'})
+        elif data.filter is not None and data.data is not None:
+            try:
+                data_edit = models.update.model_validate(data.data).model_dump(exclude_none=True)
+            except ValidationError as e:
+                raise HTTPException(422, format_validation_error(e))
+            if not data_edit:
+                raise HTTPException(422, 'data must not be empty')
+            statement = filter_element_query(update(table), table, data.filter, data.value)\
+                .values(**data_edit).returning(table.c.id)
+            results = [{'id': element_id, 'status': 'updated'}
+                       for element_id in db.execute(statement).scalars().all()]
+        else:
+            raise HTTPException(422, 'items or filter and data are required')
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(422, str(e))
+    return {
+        "updated": len([result for result in results if result['status'] == 'updated']),
+        "results": results
+    }
+
+@router.post('/brand/{brand_id}/element/batch/delete')
+async def batch_delete_element(country_alias:str, brand_id:int, data: ElementBatchDelete,
+                               user: UserResponse = Depends(get_current_user),
+                               db:Session = Depends(get_db_schemas)):
+    """
+        Delete many elements in a transaction, by ids or by a filter. Return the
+        outcome of each id
+    """
+    table = await build_table(country_alias, db, brand_id)
+    try:
+        if data.ids is not None:
+            deleted = delete_element_batch(db, table, list(set(data.ids)))
+            results = [{'id': element_id, 'status': 'deleted' if element_id in deleted else 'not_found'}
+                       for element_id in dict.fromkeys(data.ids)]
+        elif data.filter is not None:
+            statement = filter_element_query(delete(table), table, data.filter, data.value)\
+                .returning(table.c.id)
+            results = [{'id': element_id, 'status': 'deleted'}
+                       for element_id in db.execute(statement).scalars().all()]
+        else:
+            raise HTTPException(422, 'ids or filter are required')
+        db.commit()
+    except HTTPException:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(422, str(e))
+    return {
+        "deleted": len([result for result in results if result['status'] == 'deleted']),
+        "results": results
+    }
+
 @router.put('/brand/{brand_id}/element/{element_id}')
 async def update_element(country_alias:str,brand_id:int, element_id:int,
                          data:dict, user: UserResponse = Depends(get_current_user),
@@ -220,18 +655,16 @@ async def update_element(country_alias:str,brand_id:int, element_id:int,
         Endpoint to update an element dinamically
     """
     table = await build_table(country_alias, db, brand_id)
-    # brand_model = generate_pydantic_model(table)
-    # brand_model = brand_model(**data)
-    data_edit = {}
-    # Filter none values and restricted value from the edit data
-    for field, val in data.items():
-        if hasattr(table.c, field):
-            if val is not None and not field in ('id', 'updated_at', 'created_at'):
-                data_edit[field] = val
+    models = get_element_models(table)
+    try:
+        data = models.update.model_validate(data)
+    except ValidationError as e:
+        raise HTTPException(422, str(e))
+    # Filter none values, the model does not have the restricted values
+    data_edit = data.model_dump(exclude_none=True)
     statement = update(table).where(table.c.id == element_id)\
         .values(**data_edit)\
         .returning(table)
-    # .values(**brand_model.model_dump(exclude=['id', 'created_at', 'updated_at']))\
         
     result = db.execute(statement)
     db.commit()
@@ -239,9 +672,7 @@ async def update_element(country_alias:str,brand_id:int, element_id:int,
     updated_element = result.fetchone()
     if updated_element is None:
         raise HTTPException(404, 'not found')
-    # Convert the SQLAlchemy row to a dictionary 
-    updated_element_dict = {column.name: value for column, value in zip(table.columns, updated_element)}
-    return updated_element_dict
+    return models.response.model_validate(updated_element)
 
 @router.delete('/brand/{brand_id}/element/{element_id}', status_code=204)
 async def delete_element(country_alias:str,brand_id:int, element_id:int,
@@ -1,13 +1,20 @@
 """
     Testing authentication apis
 """
+import json, asyncio, threading
+from fastapi import (Request, HTTPException)
 from main import app
-from database.database import get_db
+from database.database import (get_db, get_async_db)
 from database.services import (get_current_user, get_admin_user)
 from database.models_countries import clean_string
+from database.cache import (get_cached_tenant, MISSING)
+from database.notify import (handle_notification, SENDER_ID)
+from database.services_tenant import resolve_schema_name
+from database import security
 from test.utils import *
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 app.dependency_overrides[get_current_user] = override_get_current_user
 app.dependency_overrides[get_admin_user] = override_get_admin_user
 
@@ -93,9 +100,12 @@ def test_create_country(initial_state):
         'area_code': '1'
     }
     resp = client.post('/administration/country', json=data)
-    assert resp.status_code == 201
-    assert resp.json()['name'] == data['name']
+    assert resp.status_code == 202
+    assert resp.json()['kind'] == 'create_country'
+    job = wait_job(resp.json()['id'])
+    assert job['status'] == 'done'
     schema_name = f"{clean_string(data['name'])}_{clean_string(data['alias'])}_schema"
+    assert job['schema_name'] == schema_name
     result = initial_state[1].execute(text(f"SELECT schema_name FROM information_schema.schemata WHERE schema_name = '{schema_name}'"))
     assert result.rowcount > 0
 
@@ -110,14 +120,155 @@ def test_delete_country(initial_state):
         'area_code': '1'
     }
     resp = client.post('/administration/country', json=data)
-    assert resp.status_code == 201
-    assert resp.json()['name'] == data['name']
+    assert resp.status_code == 202
+    assert resp.json()['kind'] == 'create_country'
+    job = wait_job(resp.json()['id'])
+    assert job['status'] == 'done'
     schema_name = f"{clean_string(data['name'])}_{clean_string(data['alias'])}_schema"
+    assert job['schema_name'] == schema_name
     result = initial_state[1].execute(text(f"SELECT schema_name FROM information_schema.schemata WHERE schema_name = '{schema_name}'"))
     assert result.rowcount > 0
-    country_id = resp.json()['id']
+    country_id = job['country_id']
     resp = client.delete(f'/administration/country/{country_id}')
-    assert resp.status_code == 204
+    assert resp.status_code == 202
+    assert wait_job(resp.json()['id'])['status'] == 'done'
     result = initial_state[1].execute(text(f"SELECT schema_name FROM information_schema.schemata WHERE schema_name = '{schema_name}'"))
     assert result.rowcount == 0
 
+
+def test_tenant_cache(initial_state):
+    """
+        The alias of a new country must not stay cached as a missing country
+    """
+    db = initial_state[1]
+    assert asyncio.run(resolve_schema_name('USA', db)) is None
+    assert get_cached_tenant('usa') is None
+    data = {
+        'name': 'United State of America',
+        'official_name': 'United State of America',
+        'alias': 'USA',
+        'area_code': '1'
+    }
+    resp = client.post('/administration/country', json=data)
+    assert resp.status_code == 202
+    job = wait_job(resp.json()['id'])
+    assert get_cached_tenant('usa') is MISSING
+    schema_name = f"{clean_string(data['name'])}_{clean_string(data['alias'])}_schema"
+    assert asyncio.run(resolve_schema_name('usa', db)) == schema_name
+    assert get_cached_tenant('USA') == schema_name
+    resp = client.delete(f"/administration/country/{job['country_id']}")
+    assert resp.status_code == 202
+    assert get_cached_tenant('usa') is MISSING
+    assert wait_job(resp.json()['id'])['status'] == 'done'
+
+def test_tenant_cache_misses(initial_state, monkeypatch):
+    """
+        The aliases that are not a country do not evict the cached countries
+    """
+    from database import cache
+    monkeypatch.setattr(cache, '_tenants', cache.TTLCache(2, 60))
+    monkeypatch.setattr(cache, '_missing_tenants', cache.TTLCache(2, 60))
+    db = initial_state[1]
+    schema_name = asyncio.run(resolve_schema_name(COUNTRY['alias'], db))
+    assert schema_name is not None
+    for i in range(10):
+        assert asyncio.run(resolve_schema_name(f'unknown{i}', db)) is None
+    assert get_cached_tenant(COUNTRY['alias']) == schema_name
+    assert get_cached_tenant('unknown9') is None
+    assert get_cached_tenant('unknown0') is MISSING
+
+def test_list_roles(initial_state):
+    """
+        List of roles use the async session
+    """
+    resp = client.get('/administration/rol')
+    assert resp.status_code == 200
+    names = [rol['name'] for rol in resp.json()]
+    assert names == [ROL_GUESTS_MOCK['name'], ROL_ADMIN_MOCK['name']]
+
+def test_login_rehash(initial_state, monkeypatch):
+    """
+        The hash is updated on login when the configured cost changes
+    """
+    monkeypatch.setattr(security, 'BCRYPT_ROUNDS', 4)
+    data = {
+        'username': USER_MOCK['email'],
+        'password': PASSWORD
+    }
+    resp = client.post('/administration/users/login', data=data)
+    assert resp.status_code == 200
+    db = initial_state[1]
+    user = db.query(Users).filter(Users.id == USER_MOCK['id']).first()
+    db.refresh(user)
+    assert user.password_hash.startswith('$2b$04$')
+    assert user.check_password(PASSWORD)
+
+def test_login_storm(initial_state, monkeypatch):
+    """
+        Logins over the queue limit are rejected with 429
+    """
+    monkeypatch.setattr(security, '_slots', threading.BoundedSemaphore(1))
+    security._slots.acquire()
+    data = {
+        'username': USER_MOCK['email'],
+        'password': PASSWORD
+    }
+    resp = client.post('/administration/users/login', data=data)
+    assert resp.status_code == 429
+    security._slots.release()
+    resp = client.post('/administration/users/login', data=data)
+    assert resp.status_code == 200
+
+def test_principal_cache(initial_state):
+    """
+        The principal is cached until the user is edited
+    """
+    db = initial_state[1]
+    user_id = initial_state[0]['id']
+    request = Request({'type': 'http', 'session': {'user': {'id': user_id}}})
+    principal = asyncio.run(get_current_user(request, db))
+    assert asyncio.run(get_current_user(request, db)) is principal
+    resp = client.put(f'/administration/user/{user_id}', json={'first_name': 'cache edit'})
+    assert resp.status_code == 200
+    # Each request has its own session, the edit is not in the identity map of db
+    db.expire_all()
+    principal_edit = asyncio.run(get_current_user(request, db))
+    assert principal_edit is not principal
+    assert principal_edit.first_name == 'cache edit'
+    resp = client.delete(f'/administration/user/{user_id}')
+    assert resp.status_code == 204
+    with pytest.raises(HTTPException):
+        asyncio.run(get_current_user(request, db))
+
+def test_principal_notification(initial_state):
+    """
+        A principal notification of other worker evicts the cached principal
+    """
+    db = initial_state[1]
+    user_id = initial_state[0]['id']
+    request = Request({'type': 'http', 'session': {'user': {'id': user_id}}})
+    principal = asyncio.run(get_current_user(request, db))
+    handle_notification(json.dumps({'principal': user_id, 'sender': SENDER_ID}))
+    # Own notifications are ignored
+    assert asyncio.run(get_current_user(request, db)) is principal
+    handle_notification(json.dumps({'principal': user_id, 'sender': 'other'}))
+    principal_user = asyncio.run(get_current_user(request, db))
+    assert principal_user is not principal
+    handle_notification(json.dumps({'principal': None, 'sender': 'other'}))
+    assert asyncio.run(get_current_user(request, db)) is not principal_user
+
+def test_country_job_queue(initial_state, monkeypatch):
+    """
+        The jobs over the queue limit are rejected before saving the country
+    """
+    from database import jobs
+    monkeypatch.setattr(jobs, '_slots', threading.BoundedSemaphore(0))
+    data = {
+        'name': 'Canada',
+        'official_name': 'Canada',
+        'alias': 'CA',
+        'area_code': '1'
+    }
+    resp = client.post('/administration/country', json=data)
+    assert resp.status_code == 429
+    assert initial_state[1].query(Countries).filter(Countries.alias == 'CA').first() is None
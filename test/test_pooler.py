@@ -0,0 +1,140 @@
+"""
+    Run the tenant endpoint's through a transaction pooler stand-in.
+    All the sessions share a single server connection (pool of size 1), as a pooler
+    in transaction mode does, so any state kept in the connection leaks to the
+    next request.
+"""
+import inspect
+import pytest
+from fastapi import (Request, HTTPException)
+from main import app
+from database.database import (get_db, get_async_db, tenant_session, async_tenant_session,
+                               forbid_session_state, POOLER_ASYNC_CONNECT_ARGS)
+from database.services_tenant import (get_db_schemas, get_async_db_schemas, get_schema_name,
+                                      resolve_schema_name_async, get_path_alias)
+from test import (test_tenant, test_auth)
+from test.utils import *
+
+pooler_engine = forbid_session_state(create_engine(engine.url, pool_size=1, max_overflow=0))
+PoolerSession = sessionmaker(autocommit = False, autoflush = False, bind=pooler_engine)
+# Each request of the test client runs in a new event loop, the async connections
+# cannot be shared, but the statements are checked like behind the pooler
+async_pooler_engine = create_async_engine(get_async_url(engine.url), poolclass=NullPool,
+                                          connect_args=POOLER_ASYNC_CONNECT_ARGS)
+forbid_session_state(async_pooler_engine.sync_engine)
+AsyncPoolerSession = async_sessionmaker(autoflush = False, expire_on_commit = False,
+                                        bind=async_pooler_engine)
+# Every test of the tenant and admin endpoint's runs again through the pooler
+POOLER_TESTS = [function for module in (test_tenant, test_auth)
+                for name, function in inspect.getmembers(module, inspect.isfunction)
+                if name.startswith('test_') and function.__module__ == module.__name__]
+OTHER_COUNTRY = {
+    'name': 'other',
+    'official_name': 'other',
+    'alias': 'other',
+    'area_code': '321'
+}
+
+def override_get_db_pooler():
+    db = PoolerSession()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def override_get_db_schema_pooler(request: Request):
+    db = PoolerSession()
+    try:
+        schema_name = await get_schema_name(request, db)
+    finally:
+        # Release the only server connection before opening the tenant session
+        db.close()
+    db = tenant_session(schema_name, bind=pooler_engine)
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def override_get_async_db_pooler():
+    async with AsyncPoolerSession() as db:
+        yield db
+
+async def override_get_async_db_schema_pooler(request: Request):
+    async with AsyncPoolerSession() as db:
+        schema_name = await resolve_schema_name_async(request.headers.get("host").split(".")[0], db)
+        if schema_name is None:
+            country_alias = get_path_alias(request)
+            if country_alias is not None:
+                schema_name = await resolve_schema_name_async(country_alias, db)
+        if schema_name is None:
+            raise HTTPException(404,"Country not found")
+    async with async_tenant_session(schema_name, bind=async_pooler_engine) as db:
+        yield db
+
+def get_search_path():
+    with pooler_engine.connect() as connection:
+        return connection.execute(text("SHOW search_path")).scalar()
+
+@pytest.fixture
+def pooler(initial_state):
+    overrides = app.dependency_overrides.copy()
+    app.dependency_overrides[get_db] = override_get_db_pooler
+    app.dependency_overrides[get_db_schemas] = override_get_db_schema_pooler
+    app.dependency_overrides[get_async_db] = override_get_async_db_pooler
+    app.dependency_overrides[get_async_db_schemas] = override_get_async_db_schema_pooler
+    db = initial_state[1]
+    country_db = Countries(**OTHER_COUNTRY)
+    db.add(country_db)
+    db.commit()
+    db.refresh(country_db)
+    create_schema(format_schema(country_db), db)
+    search_path = get_search_path()
+    try:
+        yield initial_state
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(overrides)
+        # Nothing done by the requests must stay in the server connection
+        assert get_search_path() == search_path
+
+def test_session_statement_rejected(pooler):
+    """
+        Session level statements are rejected, SET LOCAL is allowed
+    """
+    with pooler_engine.connect() as connection:
+        with pytest.raises(Exception):
+            connection.execute(text("SET search_path TO administration"))
+    with pooler_engine.connect() as connection:
+        with pytest.raises(Exception):
+            connection.execute(text("SELECT 1; SET search_path TO administration"))
+    with pooler_engine.connect() as connection:
+        connection.execute(text("SET LOCAL search_path TO administration"))
+        connection.rollback()
+
+@pytest.mark.parametrize('test', POOLER_TESTS, ids=lambda test: test.__name__)
+def test_suite_through_pooler(request, pooler, test):
+    """
+        The tenant and admin endpoint's work without session state
+    """
+    fixtures = {'initial_state': pooler}
+    kwargs = {name: fixtures[name] if name in fixtures else request.getfixturevalue(name)
+              for name in inspect.signature(test).parameters}
+    test(**kwargs)
+
+def test_interleaved_tenants(pooler):
+    """
+        Requests of different tenants alternate on the same server connection
+        without seeing the data of the other tenant
+    """
+    aliases = [COUNTRY['alias'], OTHER_COUNTRY['alias']]
+    for i in range(3):
+        for alias in aliases:
+            url = f'/country/{alias}/brand/1/element'
+            resp = client.post(url, json={'model': f'{alias} model {i}'})
+            assert resp.status_code == 201
+    for alias in aliases:
+        resp = client.get(f'/country/{alias}/brand/1/element')
+        assert resp.status_code == 200
+        models = [element['model'] for element in resp.json()['data']]
+        assert len(models) == 3
+        assert all(model.startswith(alias) for model in models)
@@ -1,19 +1,25 @@
 """
     Test for tenant endpoint's
 """
-import random
-from sqlalchemy import inspect
+import json, random, datetime
+from sqlalchemy import (inspect, text)
 from main import app
-from database.database import get_db
-from database.models_countries import clean_string
+from database.database import (get_db, get_async_db)
+from database.models_countries import (clean_string, purge_dropped_columns, set_index_status,
+                                       retry_failed_indexes)
 from database.services import (get_current_user, get_admin_user)
-from database.services_tenant import get_db_schemas
+from database.services_tenant import (get_db_schemas, get_async_db_schemas)
+from database.cache import (get_table, get_schema_version)
+from database.notify import (handle_notification, SENDER_ID)
+from pydantic_models.pydanctic_coutries import get_element_models
 from test.utils import *
 # Override dependencies
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
 app.dependency_overrides[get_current_user] = override_get_current_user
 app.dependency_overrides[get_admin_user] = override_get_admin_user
 app.dependency_overrides[get_db_schemas] = override_get_db_schema
+app.dependency_overrides[get_async_db_schemas] = override_get_async_db_schema
 country_alias = COUNTRY['alias']
 
 def test_create_extras(initial_state):
@@ -31,7 +37,7 @@ def test_create_extras(initial_state):
     assert resp.status_code == 201
     # Check the table of toyota has this new field
     inspector = inspect(initial_state[1].bind)
-    columns = inspector.get_columns('toyota') # brand 1
+    columns = inspector.get_columns('toyota', schema=format_schema(initial_state[2])) # brand 1
     flag = False
     column_name = clean_string(extra_data['name'])
     for col in columns:
@@ -54,7 +60,7 @@ def test_delete_extra(initial_state):
     assert resp.status_code == 201
     # Check the table of toyota has this new field
     inspector = inspect(initial_state[1].bind)
-    columns = inspector.get_columns('toyota') # brand 1
+    columns = inspector.get_columns('toyota', schema=format_schema(initial_state[2])) # brand 1
     flag = False
     column_name = clean_string(extra_data['name'])
     for col in columns:
@@ -65,8 +71,15 @@ def test_delete_extra(initial_state):
     url = f'/country/{country_alias}/extra/{extra_id}'
     resp = client.delete(url)
     assert resp.status_code == 204
+    # The column is hidden at once and dropped by the maintenance
+    resp = client.get(f'/country/{country_alias}/brand/1/element')
+    assert resp.status_code == 200
+    table = get_table(format_schema(initial_state[2]), 'toyota', engine)
+    assert column_name not in table.c
+    initial_state[1].commit()
+    assert purge_dropped_columns(format_schema(initial_state[2])) == 1
     inspector = inspect(initial_state[1].bind)
-    columns = inspector.get_columns('toyota') # brand 1
+    columns = inspector.get_columns('toyota', schema=format_schema(initial_state[2])) # brand 1
     flag = False
     column_name = clean_string(extra_data['name'])
     for col in columns:
@@ -110,4 +123,594 @@ def test_create_brand(initial_state):
         json_resp = resp.json()
         flag = 'test' in json_resp
         assert flag == True
-        assert json_resp['test'] == types_default[type_id]
\ No newline at end of file
+        assert json_resp['test'] == types_default[type_id]
+
+
+def test_table_cache(initial_state):
+    """
+        The reflected table is reused until a ddl change the schema
+    """
+    schema_name = format_schema(initial_state[2])
+    url = f'/country/{country_alias}/brand/1/element'
+    resp = client.get(url)
+    assert resp.status_code == 200
+    version = get_schema_version(schema_name)
+    table = get_table(schema_name, 'toyota', engine)
+    assert get_table(schema_name, 'toyota', engine) is table
+    extra_data = {
+        'name': 'cached field',
+        'display_name': "Cached field",
+        'type_id': 1,
+        'brand_id': 1
+    }
+    resp = client.post(f'/country/{country_alias}/extra', json=extra_data)
+    assert resp.status_code == 201
+    assert get_schema_version(schema_name) > version
+    table_new = get_table(schema_name, 'toyota', engine)
+    assert table_new is not table
+    assert 'cached_field' in table_new.c
+
+def test_ddl_notification(initial_state):
+    """
+        A ddl notification of other worker evicts the cached tables of the schema
+    """
+    schema_name = format_schema(initial_state[2])
+    table = get_table(schema_name, 'toyota', engine)
+    version = get_schema_version(schema_name)
+    payload = json.dumps({'schema': schema_name, 'table': 'toyota',
+                          'version': version + 1, 'sender': SENDER_ID})
+    handle_notification(payload)
+    # Own notifications are ignored
+    assert get_schema_version(schema_name) == version
+    payload = json.dumps({'schema': schema_name, 'table': 'toyota',
+                          'version': version + 1, 'sender': 'other'})
+    handle_notification(payload)
+    assert get_schema_version(schema_name) == version + 1
+    assert get_table(schema_name, 'toyota', engine) is not table
+
+def test_get_extras(initial_state):
+    """
+        List and details of extras use the async session
+    """
+    extra_data = {
+        'name': 'color',
+        'display_name': "Color",
+        'type_id': 2,
+        'brand_id': 2
+    }
+    resp = client.post(f'/country/{country_alias}/extra', json=extra_data)
+    assert resp.status_code == 201
+    extra_id = resp.json()['id']
+    resp = client.get(f'/country/{country_alias}/extra', params={'search': 'col'})
+    assert resp.status_code == 200
+    assert resp.json()['total'] == 1
+    assert resp.json()['data'][0]['id'] == extra_id
+    resp = client.get(f'/country/{country_alias}/extra/{extra_id}')
+    assert resp.status_code == 200
+    assert resp.json()['brand']['name'] == 'ford'
+    assert resp.json()['type_model']['name'] == 'char'
+
+def test_get_extras_filter_types(initial_state):
+    """
+        The filter value is converted to the type of the column
+    """
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'color', 'display_name': 'Color', 'type_id': 2,
+                                  'brand_id': 2})
+    assert resp.status_code == 201
+    resp = client.get(url, params={'filter': 'brand_id', 'value': '2'})
+    assert resp.status_code == 200
+    assert resp.json()['total'] == 1
+    resp = client.get(url, params={'filter': 'brand_id', 'value': '1'})
+    assert resp.json()['total'] == 0
+    resp = client.get(url, params={'filter': 'fixable', 'value': 'true'})
+    assert resp.status_code == 200
+    assert resp.json()['total'] == 1
+    resp = client.get(url, params={'filter': 'brand_id', 'value': 'ford'})
+    assert resp.status_code == 422
+
+def test_list_element_count(initial_state):
+    """
+        The total is counted without fetching every row
+    """
+    url = f'/country/{country_alias}/brand/1/element'
+    for i in range(5):
+        resp = client.post(url, json={'model': f'corolla {i}'})
+        assert resp.status_code == 201
+    resp = client.post(url, json={'model': 'yaris'})
+    assert resp.status_code == 201
+    resp = client.get(url, params={'size': 2})
+    assert resp.status_code == 200
+    assert resp.json()['total'] == 6
+    assert resp.json()['total_pages'] == 3
+    assert len(resp.json()['data']) == 2
+    assert '__total' not in resp.json()['data'][0]
+    params = {'size': 2, 'filter': 'model', 'value': 'corolla'}
+    resp = client.get(url, params=params)
+    assert resp.json()['total'] == 5
+    resp = client.get(url, params={**params, 'page': 4})
+    assert resp.status_code == 404
+    resp = client.get(url, params={**params, 'count': 'none'})
+    assert resp.status_code == 200
+    assert resp.json()['total'] is None
+    assert len(resp.json()['data']) == 2
+    resp = client.get(url, params={**params, 'count': 'estimate'})
+    assert resp.status_code == 200
+    assert isinstance(resp.json()['total'], int)
+    ids = [element['id'] for element in client.get(url).json()['data']]
+    resp = client.get(url, params={'count': 'estimate', 'where': f'id:in:{ids[0]},{ids[2]}'})
+    assert resp.status_code == 200
+    assert isinstance(resp.json()['total'], int)
+    assert len(resp.json()['data']) == 2
+
+def test_list_element_cursor(initial_state):
+    """
+        Cursor pagination walks every element once, the cursor keeps the filter
+    """
+    url = f'/country/{country_alias}/brand/3/element'
+    for i in range(5):
+        resp = client.post(url, json={'model': f'camaro {i}'})
+        assert resp.status_code == 201
+    resp = client.post(url, json={'model': 'spark'})
+    assert resp.status_code == 201
+    params = {'size': 2, 'filter': 'model', 'value': 'camaro', 'pagination': 'cursor'}
+    resp = client.get(url, params=params)
+    assert resp.status_code == 200
+    models = [element['model'] for element in resp.json()['data']]
+    next_cursor = resp.json()['next_cursor']
+    while next_cursor is not None:
+        resp = client.get(url, params={'cursor': next_cursor, 'size': 2})
+        assert resp.status_code == 200
+        models += [element['model'] for element in resp.json()['data']]
+        next_cursor = resp.json()['next_cursor']
+    assert models == [f'camaro {i}' for i in range(4, -1, -1)]
+    resp = client.get(url, params={'cursor': 'invalid'})
+    assert resp.status_code == 422
+
+def test_get_extras_cursor(initial_state):
+    """
+        Cursor pagination of the extras
+    """
+    for i in range(30):
+        extra_data = {
+            'name': f'extra {i}',
+            'display_name': f"Extra {i}",
+            'type_id': 1,
+            'brand_id': 1
+        }
+        resp = client.post(f'/country/{country_alias}/extra', json=extra_data)
+        assert resp.status_code == 201
+    url = f'/country/{country_alias}/extra'
+    resp = client.get(url, params={'pagination': 'cursor', 'search': 'extra'})
+    assert resp.status_code == 200
+    assert len(resp.json()['data']) == 25
+    resp = client.get(url, params={'cursor': resp.json()['next_cursor']})
+    assert resp.status_code == 200
+    assert len(resp.json()['data']) == 5
+    assert resp.json()['next_cursor'] is None
+
+def test_element_models_cache(initial_state):
+    """
+        The generated models are reused until the ddl version changes
+    """
+    schema_name = format_schema(initial_state[2])
+    table = get_table(schema_name, 'ford', engine)
+    models = get_element_models(table)
+    assert get_element_models(get_table(schema_name, 'ford', engine)) is models
+    assert 'id' not in models.create.model_fields
+    assert 'id' in models.response.model_fields
+    extra_data = {
+        'name': 'doors',
+        'display_name': "Doors",
+        'type_id': 3,
+        'brand_id': 2
+    }
+    resp = client.post(f'/country/{country_alias}/extra', json=extra_data)
+    assert resp.status_code == 201
+    models_new = get_element_models(get_table(schema_name, 'ford', engine))
+    assert models_new is not models
+    assert 'doors' in models_new.update.model_fields
+    url = f'/country/{country_alias}/brand/2/element'
+    resp = client.post(url, json={'model': 'focus', 'doors': 'four'})
+    assert resp.status_code == 422
+    resp = client.post(url, json={'model': 'focus', 'doors': 4})
+    assert resp.status_code == 201
+    element_id = resp.json()['id']
+    resp = client.put(f'{url}/{element_id}', json={'doors': 'five'})
+    assert resp.status_code == 422
+    resp = client.put(f'{url}/{element_id}', json={'doors': 5})
+    assert resp.status_code == 200
+    assert resp.json()['doors'] == 5
+    assert resp.json()['model'] == 'focus'
+
+def test_bulk_create_element(initial_state):
+    """
+        Bulk upload of elements in ndjson and csv, the invalid rows are reported
+    """
+    extra_data = {
+        'name': 'year',
+        'display_name': "Year",
+        'type_id': 3,
+        'brand_id': 1
+    }
+    resp = client.post(f'/country/{country_alias}/extra', json=extra_data)
+    assert resp.status_code == 201
+    url = f'/country/{country_alias}/brand/1/element/bulk'
+    rows = [json.dumps({'model': f'corolla {i}', 'year': 2000 + i}) for i in range(10)]
+    rows.insert(3, json.dumps({'model': 'bad', 'year': 'not a year'}))
+    rows.insert(5, '{not json')
+    body = '\n'.join(rows)
+    resp = client.post(url, content=body, params={'batch_size': 4},
+                       headers={'content-type': 'application/x-ndjson'})
+    assert resp.status_code == 200
+    assert resp.json()['inserted'] == 10
+    assert [error['line'] for error in resp.json()['errors']] == [4, 6]
+    resp = client.get(f'/country/{country_alias}/brand/1/element', params={'size': 100})
+    assert resp.json()['total'] == 10
+    assert all(element['user_id'] == USER_MOCK['id'] for element in resp.json()['data'])
+    body = 'model,year\ncamry,2020\ncamry,\ncamry,twenty\n'
+    resp = client.post(url, content=body, headers={'content-type': 'text/csv'})
+    assert resp.status_code == 200
+    assert resp.json()['inserted'] == 2
+    assert [error['line'] for error in resp.json()['errors']] == [4]
+    resp = client.post(url, content=body, params={'all_or_nothing': True},
+                       headers={'content-type': 'text/csv'})
+    assert resp.status_code == 422
+    resp = client.get(f'/country/{country_alias}/brand/1/element')
+    assert resp.json()['total'] == 12
+    # A quoted line break is part of the value, the next rows keep their line
+    body = 'model,year\n"land\ncruiser",2021\ncamry,twenty\n"hilux",2022\n'
+    resp = client.post(url, content=body, headers={'content-type': 'text/csv'})
+    assert resp.status_code == 200
+    assert resp.json()['inserted'] == 2
+    assert [error['line'] for error in resp.json()['errors']] == [4]
+    resp = client.get(f'/country/{country_alias}/brand/1/element',
+                      params={'filter': 'model', 'value': 'land'})
+    assert resp.json()['data'][0]['model'] == 'land\ncruiser'
+
+def test_export_element(initial_state):
+    """
+        Export the filtered elements as ndjson and csv
+    """
+    url = f'/country/{country_alias}/brand/2/element'
+    for i in range(5):
+        resp = client.post(url, json={'model': f'mustang {i}'})
+        assert resp.status_code == 201
+    resp = client.post(url, json={'model': 'ranger'})
+    assert resp.status_code == 201
+    params = {'filter': 'model', 'value': 'mustang'}
+    resp = client.get(f'{url}/export', params=params)
+    assert resp.status_code == 200
+    rows = [json.loads(line) for line in resp.text.splitlines()]
+    assert [row['model'] for row in rows] == [f'mustang {i}' for i in range(4, -1, -1)]
+    resp = client.get(f'{url}/export', params={'format': 'csv'})
+    assert resp.status_code == 200
+    lines = resp.text.splitlines()
+    assert lines[0].split(',')[:3] == ['id', 'user_id', 'model']
+    assert len(lines) == 7
+
+def test_batch_update_delete_element(initial_state):
+    """
+        Batch update and delete report the outcome of each id
+    """
+    url = f'/country/{country_alias}/brand/3/element'
+    ids = []
+    for i in range(4):
+        resp = client.post(url, json={'model': f'malibu {i}'})
+        assert resp.status_code == 201
+        ids.append(resp.json()['id'])
+    items = [{'id': ids[0], 'data': {'model': 'impala'}},
+             {'id': ids[1], 'data': {'model': 'tahoe'}},
+             {'id': ids[2], 'data': {}},
+             {'id': 9999, 'data': {'model': 'ghost'}}]
+    resp = client.put(f'{url}/batch', json={'items': items})
+    assert resp.status_code == 200
+    assert resp.json()['updated'] == 2
+    status = {result['id']: result['status'] for result in resp.json()['results']}
+    assert status == {ids[0]: 'updated', ids[1]: 'updated', ids[2]: 'invalid',
+                      9999: 'not_found'}
+    items = [{'id': ids[0], 'data': {'model': 'corolla'}},
+             {'id': ids[0], 'data': {'model': 'camry'}}]
+    resp = client.put(f'{url}/batch', json={'items': items})
+    assert resp.status_code == 422
+    assert str(ids[0]) in resp.json()['detail']
+    resp = client.put(f'{url}/batch', json={'filter': 'model', 'value': 'malibu',
+                                            'data': {'model': 'malibu new'}})
+    assert resp.json()['updated'] == 2
+    resp = client.get(url, params={'filter': 'model', 'value': 'impala'})
+    assert resp.json()['total'] == 1
+    resp = client.post(f'{url}/batch/delete', json={'ids': [ids[0], ids[1], 9999]})
+    assert resp.status_code == 200
+    assert resp.json()['deleted'] == 2
+    resp = client.post(f'{url}/batch/delete', json={'filter': 'model', 'value': 'malibu new'})
+    assert resp.json()['deleted'] == 2
+    resp = client.get(url)
+    assert resp.json()['total'] == 0
+
+def test_list_element_fields(initial_state):
+    """
+        Only the requested fields are returned
+    """
+    url = f'/country/{country_alias}/brand/1/element'
+    for i in range(3):
+        resp = client.post(url, json={'model': f'prius {i}'})
+        assert resp.status_code == 201
+    resp = client.get(url, params={'fields': 'model'})
+    assert resp.status_code == 200
+    assert resp.json()['total'] == 3
+    assert all(set(element) == {'id', 'model'} for element in resp.json()['data'])
+    resp = client.get(url, params={'fields': 'model,unknown'})
+    assert resp.status_code == 422
+    resp = client.get(url, params={'fields': 'user_id', 'pagination': 'cursor', 'size': 2})
+    assert set(resp.json()['data'][0]) == {'id', 'user_id'}
+    resp = client.get(url, params={'cursor': resp.json()['next_cursor']})
+    assert [set(element) for element in resp.json()['data']] == [{'id', 'user_id'}]
+    resp = client.get(f'{url}/export', params={'fields': 'model'})
+    assert set(json.loads(resp.text.splitlines()[0])) == {'id', 'model'}
+
+def test_list_element_where(initial_state):
+    """
+        Typed filters over the columns of the brand
+    """
+    url = f'/country/{country_alias}/brand/1/element'
+    for name in ['prius', 'prado', 'corolla']:
+        resp = client.post(url, json={'model': name})
+        assert resp.status_code == 201
+    resp = client.get(url, params={'where': 'model:prefix:pr'})
+    assert {element['model'] for element in resp.json()['data']} == {'prius', 'prado'}
+    resp = client.get(url, params={'where': ['model:prefix:pr', 'model:ne:prado']})
+    assert [element['model'] for element in resp.json()['data']] == ['prius']
+    resp = client.get(url, params={'where': 'id:in:1,3'})
+    assert {element['id'] for element in resp.json()['data']} == {1, 3}
+    resp = client.get(url, params={'where': 'id:range:2,'})
+    assert resp.json()['total'] == 2
+    resp = client.get(url, params={'where': 'model:is_null:false'})
+    assert resp.json()['total'] == 3
+    resp = client.get(url, params={'where': 'id:gt:abc'})
+    assert resp.status_code == 422
+    resp = client.get(url, params={'where': 'id:like:1'})
+    assert resp.status_code == 422
+    resp = client.get(url, params={'where': 'model:prefix:pr', 'pagination': 'cursor', 'size': 1})
+    resp = client.get(url, params={'cursor': resp.json()['next_cursor']})
+    assert [element['model'] for element in resp.json()['data']] == ['prius']
+
+def test_indexed_extra(initial_state):
+    """
+        An indexed extra builds its index, it is renamed and dropped with the column
+    """
+    skip_without_extension('pg_trgm')
+    # CREATE INDEX CONCURRENTLY waits for the open transactions
+    initial_state[1].commit()
+    schema_name = format_schema(initial_state[2])
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'plate', 'display_name': 'Plate', 'type_id': 1,
+                                  'brand_id': 1, 'indexed': True, 'index_type': 'trigram'})
+    assert resp.status_code == 201
+    assert resp.json()['index_status'] == 'pending'
+    extra_id = resp.json()['id']
+    resp = client.get(f'{url}/{extra_id}')
+    assert resp.json()['index_status'] == 'ready'
+    indexes = inspect(initial_state[1].bind).get_indexes('toyota', schema=schema_name)
+    assert 'ix_extra_toyota_plate' in [index['name'] for index in indexes]
+    resp = client.put(f'{url}/{extra_id}', json={'name': 'plate_number', 'display_name': 'Plate'})
+    assert resp.status_code == 200
+    indexes = inspect(initial_state[1].bind).get_indexes('toyota', schema=schema_name)
+    assert 'ix_extra_toyota_plate_number' in [index['name'] for index in indexes]
+    resp = client.put(f'{url}/{extra_id}', json={'name': 'plate_number', 'display_name': 'Plate',
+                                                 'indexed': False})
+    assert resp.json()['index_status'] is None
+    indexes = inspect(initial_state[1].bind).get_indexes('toyota', schema=schema_name)
+    assert 'ix_extra_toyota_plate_number' not in [index['name'] for index in indexes]
+    resp = client.post(url, json={'name': 'year', 'display_name': 'Year', 'type_id': 3,
+                                  'brand_id': 1, 'indexed': True, 'index_type': 'trigram'})
+    assert resp.status_code == 422
+
+def test_retry_failed_index(initial_state):
+    """
+        A failed index build is built again by the maintenance
+    """
+    initial_state[1].commit()
+    schema_name = format_schema(initial_state[2])
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'vin', 'display_name': 'Vin', 'type_id': 1,
+                                  'brand_id': 1, 'indexed': True})
+    assert resp.status_code == 201
+    extra_id = resp.json()['id']
+    initial_state[1].execute(text(f"DROP INDEX {schema_name}.ix_extra_toyota_vin"))
+    initial_state[1].commit()
+    set_index_status(schema_name, extra_id, 'failed')
+    assert retry_failed_indexes(schema_name) == 1
+    resp = client.get(f'{url}/{extra_id}')
+    assert resp.json()['index_status'] == 'ready'
+    indexes = inspect(initial_state[1].bind).get_indexes('toyota', schema=schema_name)
+    assert 'ix_extra_toyota_vin' in [index['name'] for index in indexes]
+    assert retry_failed_indexes(schema_name) == 0
+
+def test_schema_without_trigram(initial_state, monkeypatch):
+    """
+        Without pg_trgm the schemas are created without the trigram indexes and the
+        trigram features are rejected
+    """
+    from database import models_countries
+    monkeypatch.setattr(models_countries, '_extensions', set())
+    create_schema('no_trigram_schema')
+    indexes = inspect(engine).get_indexes('extras', schema='no_trigram_schema')
+    names = [index['name'] for index in indexes]
+    assert 'ix_extras_brand_id' in names
+    assert 'ix_extras_name_trgm' not in names
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'plate', 'display_name': 'Plate', 'type_id': 1,
+                                  'brand_id': 1, 'indexed': True, 'index_type': 'trigram'})
+    assert resp.status_code == 422
+    resp = client.get(url, params={'search': 'plate', 'search_mode': 'trigram'})
+    assert resp.status_code == 422
+
+def test_get_extras_trigram(initial_state):
+    """
+        Trigram search sorts by similarity and matches the ids exactly
+    """
+    skip_without_extension('pg_trgm')
+    url = f'/country/{country_alias}/extra'
+    for name, brand_id in [('color', 1), ('colour', 2), ('plate', 3)]:
+        resp = client.post(url, json={'name': name, 'display_name': name.title(),
+                                      'type_id': 2, 'brand_id': brand_id})
+        assert resp.status_code == 201
+    indexes = inspect(initial_state[1].bind).get_indexes('extras',
+                                                         schema=format_schema(initial_state[2]))
+    assert 'ix_extras_name_trgm' in [index['name'] for index in indexes]
+    resp = client.get(url, params={'search': 'colour', 'search_mode': 'trigram'})
+    assert resp.status_code == 200
+    assert [extra['name'] for extra in resp.json()['data']] == ['colour', 'color']
+    resp = client.get(url, params={'search': '3', 'search_mode': 'trigram'})
+    assert [extra['name'] for extra in resp.json()['data']] == ['plate']
+    resp = client.get(url, params={'search': 'colour', 'search_mode': 'trigram',
+                                   'pagination': 'cursor'})
+    assert resp.status_code == 422
+
+def test_change_extra_type(initial_state):
+    """
+        The type of an extra is changed in batches and the values are kept
+    """
+    # The swap of the columns waits for the open transactions of the table
+    initial_state[1].commit()
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'year', 'display_name': 'Year', 'type_id': 2,
+                                  'brand_id': 1})
+    assert resp.status_code == 201
+    extra_id = resp.json()['id']
+    element_url = f'/country/{country_alias}/brand/1/element'
+    for year in ['2001', '2002', None]:
+        resp = client.post(element_url, json={'model': 'corolla', 'year': year})
+        assert resp.status_code == 201
+    resp = client.put(f'{url}/{extra_id}/type', json={'type_id': 3, 'batch_size': 2})
+    assert resp.status_code == 202
+    resp = client.get(f'{url}/{extra_id}/type')
+    assert resp.json()['status'] == 'done'
+    assert resp.json()['processed'] == 3
+    resp = client.get(f'{url}/{extra_id}')
+    assert resp.json()['type_model']['name'] == 'integer'
+    resp = client.get(element_url)
+    assert sorted(element['year'] for element in resp.json()['data'] if element['year']) == [2001, 2002]
+    assert all(not key.startswith('__') for key in resp.json()['data'][0])
+    # A value that cannot be converted fails the change and keeps the column
+    resp = client.post(element_url, json={'model': 'corolla', 'year': 2003})
+    resp = client.post(url, json={'name': 'plate', 'display_name': 'Plate', 'type_id': 2,
+                                  'brand_id': 1})
+    plate_id = resp.json()['id']
+    resp = client.post(element_url, json={'model': 'yaris', 'plate': 'abc'})
+    resp = client.put(f'{url}/{plate_id}/type', json={'type_id': 3})
+    assert resp.status_code == 202
+    resp = client.get(f'{url}/{plate_id}/type')
+    assert resp.json()['status'] == 'failed'
+    columns = inspect(initial_state[1].bind).get_columns('toyota',
+                                                         schema=format_schema(initial_state[2]))
+    assert '__plate' not in [column['name'] for column in columns]
+    resp = client.get(f'{url}/{plate_id}')
+    assert resp.json()['type_model']['name'] == 'char'
+
+def test_batch_extras(initial_state):
+    """
+        Many extras are created and edited in one transaction
+    """
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'color', 'display_name': 'Color', 'type_id': 2,
+                                  'brand_id': 1})
+    color_id = resp.json()['id']
+    data = {
+        'create': [{'name': f'field {i}', 'display_name': f'Field {i}', 'type_id': 2,
+                    'brand_id': 1 + i % 2} for i in range(4)],
+        'edit': [{'id': color_id, 'name': 'paint', 'display_name': 'Paint'}],
+    }
+    resp = client.post(f'{url}/batch', json=data)
+    assert resp.status_code == 201
+    assert len(resp.json()) == 5
+    schema_name = format_schema(initial_state[2])
+    columns = [column['name'] for column in
+               inspect(initial_state[1].bind).get_columns('toyota', schema=schema_name)]
+    assert {'field_0', 'field_2', 'paint'} <= set(columns)
+    assert 'color' not in columns
+    # A column that already exists rolls back the whole batch
+    data = {
+        'create': [{'name': 'wheels', 'display_name': 'Wheels', 'type_id': 3, 'brand_id': 1},
+                   {'name': 'field 1', 'display_name': 'Field 1', 'type_id': 2, 'brand_id': 2}],
+    }
+    resp = client.post(f'{url}/batch', json=data)
+    assert resp.status_code == 422
+    columns = [column['name'] for column in
+               inspect(initial_state[1].bind).get_columns('toyota', schema=schema_name)]
+    assert 'wheels' not in columns
+    resp = client.get(url, params={'filter': 'name', 'value': 'wheels'})
+    assert resp.json()['total'] == 0
+
+def test_run_migrations(initial_state):
+    """
+        The migrations bring an old schema to the last version and resume
+    """
+    from database.migrations import (run_migrations, LATEST_VERSION)
+    initial_state[1].commit()
+    schema_name = format_schema(initial_state[2])
+    results = {result['schema']: result for result in run_migrations(workers=2)}
+    assert results[schema_name]['status'] == 'done'
+    assert results[schema_name]['version'] == LATEST_VERSION
+    # Nothing is applied twice
+    assert run_migrations([schema_name], workers=2)[0]['applied'] == 0
+    # A schema created before the index columns of the extras
+    with engine.begin() as connection:
+        connection.execute(text(f"ALTER TABLE {schema_name}.extras DROP COLUMN index_status"))
+        connection.execute(text("UPDATE administration.schema_migrations SET version = 0 "
+                                "WHERE schema_name = :schema_name"), {'schema_name': schema_name})
+    results = run_migrations([schema_name], workers=1, target=1)
+    assert results[0]['applied'] == 1
+    columns = inspect(engine).get_columns('extras', schema=schema_name)
+    assert 'index_status' in [column['name'] for column in columns]
+    assert run_migrations([schema_name], workers=1)[0]['version'] == LATEST_VERSION
+
+
+def test_recreate_deleted_extra(initial_state):
+    """
+        The name of a deleted extra can be used again after its column is dropped
+    """
+    url = f'/country/{country_alias}/extra'
+    extra_data = {'name': 'plate', 'display_name': 'Plate', 'type_id': 2, 'brand_id': 1}
+    resp = client.post(url, json=extra_data)
+    assert resp.status_code == 201
+    resp = client.delete(f"{url}/{resp.json()['id']}")
+    assert resp.status_code == 204
+    resp = client.get(f'/country/{country_alias}/brand/1/element')
+    assert resp.status_code == 200
+    resp = client.post(url, json=extra_data)
+    assert resp.status_code == 409
+    initial_state[1].commit()
+    assert purge_dropped_columns(format_schema(initial_state[2])) == 1
+    resp = client.post(url, json=extra_data)
+    assert resp.status_code == 201
+    resp = client.post(f'/country/{country_alias}/brand/1/element', json={'plate': 'abc'})
+    assert resp.status_code == 201
+    assert resp.json()['plate'] == 'abc'
+
+
+def test_resume_extra_type_change(initial_state):
+    """
+        A type change stopped by a restart is resumed by the maintenance
+    """
+    from database.models_countries import (ExtraTypeChange, resume_type_changes)
+    initial_state[1].commit()
+    schema_name = format_schema(initial_state[2])
+    url = f'/country/{country_alias}/extra'
+    resp = client.post(url, json={'name': 'doors', 'display_name': 'Doors', 'type_id': 2,
+                                  'brand_id': 1})
+    extra_id = resp.json()['id']
+    resp = client.post(f'/country/{country_alias}/brand/1/element', json={'doors': '4'})
+    assert resp.status_code == 201
+    # A change left in pending by a worker that stopped
+    with tenant_session(schema_name, bind=engine) as db:
+        db.add(ExtraTypeChange(extra_id=extra_id, type_id=3, status='pending',
+                               updated_at=datetime.datetime(2000, 1, 1)))
+        db.commit()
+    resp = client.put(f'{url}/{extra_id}', json={'name': 'doors', 'display_name': 'Doors'})
+    assert resp.status_code == 409
+    assert resume_type_changes(schema_name) == 1
+    assert client.get(f'{url}/{extra_id}/type').json()['status'] == 'done'
+    resp = client.get(f'/country/{country_alias}/brand/1/element')
+    assert resp.json()['data'][0]['doors'] == 4
+    assert resume_type_changes(schema_name) == 0